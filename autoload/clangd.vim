@@ -144,6 +144,15 @@ fu! s:SetUpSyntasticHl()
       highlight link clangdWarningSection SpellCap
     endif
   endif
+
+  " text properties drawn with the groups above
+  if has('textprop')
+    for l:group in ['clangdErrorSection', 'clangdWarningSection']
+      if empty(prop_type_get(l:group))
+        call prop_type_add(l:group, {'highlight': l:group})
+      endif
+    endfor
+  endif
 endf
 
 fu! s:SetUpFirstRun()
@@ -175,6 +184,15 @@ fu! s:SetUpFirstRun()
     if !exists('g:clangd#codecomplete_timeout')
        let g:clangd#codecomplete_timeout = 100
     endif
+    if !exists('g:clangd#request_ttl')
+       let g:clangd#request_ttl = 60000
+    endif
+    if !exists('g:clangd#change_debounce_ms')
+       let g:clangd#change_debounce_ms = 200
+    endif
+    if !exists('g:clangd#async_completion')
+       let g:clangd#async_completion = 0
+    endif
 
     " Python Setup
     if g:clangd#py_version == 3
@@ -299,6 +317,56 @@ fu! s:TextChanged()
   Python handler.OnTextChanged()
 endf
 
+fu! clangd#OnBufferLinesChanged(bufnr, start, end, added, changes)
+  Python handler.OnBufferLinesChanged(int(vim.eval('a:bufnr')), vim.eval('a:changes'))
+endf
+
+fu! clangd#OnChangeTimer(timer)
+  Python handler.OnChangeTimer(int(vim.eval('a:timer')))
+endf
+
+fu! clangd#OnCompletionTimer(timer)
+  let ret = s:PyEval('handler.OnCompletionTimer()')
+  if empty(ret)
+    return
+  endif
+  call complete(ret[0], ret[1])
+endf
+
+" Applies a diagnostics update to a buffer at once. Text properties of
+" clear_types are all removed, others are removed as [id, line it was added on]
+" and added as [id, line, column, type]. Signs are removed by id and added as
+" [id, line, name].
+fu! clangd#RenderDiagnostics(bufnr, group, clear_types, removed_props, added_props, removed_signs, added_signs)
+  if !bufexists(a:bufnr)
+    return 0
+  endif
+  if bufloaded(a:bufnr)
+    for l:type in a:clear_types
+      call prop_remove({'type': l:type, 'bufnr': a:bufnr, 'all': 1})
+    endfor
+    for [l:id, l:lnum] in a:removed_props
+      " look on its line first, the whole buffer if it has moved
+      if prop_remove({'id': l:id, 'bufnr': a:bufnr}, l:lnum, l:lnum) == 0
+        call prop_remove({'id': l:id, 'bufnr': a:bufnr, 'all': 1})
+      endif
+    endfor
+    let l:last = getbufinfo(a:bufnr)[0].linecount
+    for [l:id, l:lnum, l:col, l:type] in a:added_props
+      let l:lnum = min([l:lnum, l:last])
+      let l:len = strlen(getbufline(a:bufnr, l:lnum)[0])
+      call prop_add(l:lnum, max([1, min([l:col, l:len])]), {'bufnr': a:bufnr,
+            \ 'id': l:id, 'type': l:type, 'length': l:len ? 1 : 0})
+    endfor
+  endif
+  call sign_unplacelist(map(copy(a:removed_signs),
+        \ {_, id -> {'id': id, 'group': a:group, 'buffer': a:bufnr}}))
+  call sign_placelist(map(copy(a:added_signs),
+        \ {_, sign -> {'id': sign[0], 'lnum': sign[1], 'name': sign[2],
+        \ 'group': a:group, 'buffer': a:bufnr}}))
+  return 0
+endf
+
 " Helpers
 fu! s:FilterCurrentFile()
   return s:PyEval('FilterCurrentFile()')
@@ -437,6 +505,14 @@ fu! s:PyEval(line)
     endif
 endf
 
+fu! clangd#Stats()
+  return s:PyEval('handler.GetStats()')
+endf
+
+fu! s:EchoStats()
+  Python handler.EchoStats()
+endf
+
 fu! ClangdStatuslineFlag()
   return s:PyEval('handler.ErrorStatusForCurrentLine()')
 endf
@@ -446,12 +522,13 @@ command! ClangdCodeComplete call feedkeys("\<C-X>\<C-U>\<C-P>", 'n')
 command! ClangdDiags call s:ShowDiagnostics()
 command! ClangdShowDetailedDiagnostic call s:ShowDetailedDiagnostic()
 command! ClangdForceCompile call s:ForceCompile()
-" command! ClangdGotoDefinition call s:GotoDefinition()
-" command! ClangdShowCursorDetail call s:ShowCursorDetail()
+command! ClangdGotoDefinition call s:GotoDefinition()
+command! ClangdShowCursorDetail call s:ShowCursorDetail()
 command! ClangdStartServer call s:StartServer()
 command! ClangdStopServer call s:StopServer()
 command! ClangdRestartServer call s:RestartServer()
 command! ClangdFormat call s:Format()
 command! ClangdInstallBinary call s:DownloadBinary()
+command! ClangdStats call s:EchoStats()
 
 call s:restore_cpo()
@@ -4,12 +4,23 @@ import vim
 
 from clangd import vimsupport
 from clangd.vimsupport import GetBoolValue, GetIntValue, GetVariableValue
-from clangd.lsp_client import LSPClient, TimedOutError
-from clangd.trie import Trie
+from clangd.lsp_client import (LSPClient, TimedOutError, Completion_REQUEST,
+                               Formatting_REQUEST, RangeFormatting_REQUEST,
+                               Definition_REQUEST, Hover_REQUEST)
+from clangd.result_cache import ResultCache
+from clangd.diagnostics_renderer import DiagnosticsRenderer
+from clangd.prefix_index import PrefixIndex, TopPrefixMatches
+from clangd.fuzzy_match import FuzzyIndex
+from clangd.document_sync import (ComputeContentChanges, ReplaceLinesChange,
+                                  SyncKind_INCREMENTAL)
 from clangd import glog as log
 
 
 DEFAULT_TRIGGER_STYLE = ['.', '>']
+# how often a pending async completion is checked
+COMPLETION_POLL_MS = 20
+# most items offered in the popup
+COMPLETION_LIMIT = 50
 
 def FilterFileName(file_name):
     for buf in vim.buffers:
@@ -101,26 +112,92 @@ def CompletionItemKind(kind):
     return ''
 
 
+# a cached result may be None
+_MISSING = object()
+
+
+def _CompletionWord(completion):
+    # insertText is missing from old clangd, we try to keep compatibility here
+    if 'insertText' in completion:
+        return completion['insertText']
+    return completion['label']
+
+
+def _VimCompletionItem(completion):
+    return {
+        'word':  # The actual completion
+        _CompletionWord(completion),
+        'kind':  # The type of completion, one character
+        CompletionItemKind(completion['kind']),
+        # description
+        'info': completion.get('detail', completion['label']),
+        'icase': 1,  # ignore case
+        'dup': 1  # allow duplicates
+    }
+
+
+def _DefinitionLocation(response):
+    """Returns (uri, line, character) of the first location in a definition
+    response, None if there isn't any."""
+    # Location, Location[] or LocationLink[]
+    if isinstance(response, list):
+        response = response[0] if response else None
+    if not response:
+        return None
+    uri = response.get('uri', response.get('targetUri'))
+    start = response.get('range', response.get('targetSelectionRange'))
+    if not uri or not start:
+        return None
+    start = start['start']
+    return uri, start['line'], start['character']
+
+
+def _HoverText(response):
+    # MarkupContent, MarkedString or MarkedString[]
+    if not response or not response.get('contents'):
+        return ''
+    contents = response['contents']
+    if not isinstance(contents, list):
+        contents = [contents]
+    texts = []
+    for content in contents:
+        if isinstance(content, dict):
+            content = content.get('value', '')
+        texts.append(content.strip())
+    return '\n'.join(text for text in texts if text)
+
+
 class ClangdManager(object):
     def __init__(self):
         self.lined_diagnostics = {}
+        self._diagnostics_renderer = DiagnosticsRenderer()
         self.state = {}
         self._client = None
         self._in_shutdown = False
         self._documents = {}
+        # buffer number -> uri, for documents fed by vim listeners
+        self._listened_buffers = {}
+        # debounce timer id -> uri
+        self._change_timers = {}
+        self._change_debounce_ms = 0
         self._triggerCharacters = set(DEFAULT_TRIGGER_STYLE)
+        self._incremental_sync = False
         self._computed_completions_words = []
-        self._ClearLastCompletions()
-
-    def _ClearLastCompletions(self):
-        self._last_completions = self._GetEmptyCompletions()
-        self._last_completions_pos = (-1, -1)
+        self._completion_session = None
+        self._async_completion = False
+        self._completion_timer = None
+        self._prefetch_completions = False
+        # how often a prefetched completion was ready when asked for
+        self._prefetch_stats = {'hits': 0, 'late': 0, 'misses': 0, 'unused': 0}
+        self._results = ResultCache()
+        # definition and hover being fetched for the cursor on CursorHold
+        self._cursor_prefetch = None
 
     def _GetEmptyCompletions(self):
-        completions_tries = {}
+        completions_indexes = {}
         for kind in GetCompletionItemKinds():
-            completions_tries[kind] = Trie()
-        return completions_tries
+            completions_indexes[kind] = PrefixIndex()
+        return completions_indexes
 
     def isAlive(self):
         return self._client and self._client.isAlive()
@@ -140,12 +217,26 @@ class ClangdManager(object):
             clangd_log_path = expanduser(
                 GetVariableValue('g:clangd#log_path') + '/clangd.log')
             try:
-                self._client = LSPClient(clangd_executable, clangd_log_path,
-                                         self)
+                self._client = LSPClient(
+                    clangd_executable,
+                    clangd_log_path,
+                    self,
+                    pending_ttl_ms=GetIntValue('g:clangd#request_ttl'))
+                if GetBoolValue("has('timers')"):
+                    self._change_debounce_ms = GetIntValue(
+                        'g:clangd#change_debounce_ms')
+                    self._async_completion = GetBoolValue(
+                        'g:clangd#async_completion')
+                self._prefetch_completions = GetBoolValue(
+                    'g:clangd#completions_enabled')
                 rr = self._client.initialize()
                 capabilities = rr['capabilities']
                 if 'completionProvider' in capabilities and 'triggerCharacters' in capabilities['completionProvider']:
                     self._triggerCharacters = set(capabilities['completionProvider']['triggerCharacters'])
+                sync = capabilities.get('textDocumentSync')
+                if isinstance(sync, dict):
+                    sync = sync.get('change')
+                self._incremental_sync = sync == SyncKind_INCREMENTAL
             except:
                 if self._client:
                     client = self._client
@@ -162,6 +253,11 @@ class ClangdManager(object):
             self._in_shutdown = True
         if confirmed or vimsupport.PresentYesOrNoDialog(
                 'Should we stop backend?'):
+            # the poll timer repeats, it would outlive the manager
+            self._StopCompletionPolling()
+            self._completion_session = None
+            # drops the buffer listeners and debounce timers as well
+            self._ForgetDocuments()
             try:
                 if self._client:
                     client = self._client
@@ -181,18 +277,29 @@ class ClangdManager(object):
         self.stopServer(confirmed=True)
         self.startServer(confirmed=True)
 
+    def GetStats(self):
+        stats = {}
+        if self._client:
+            stats['requests'] = self._client.pendingRequestCounts()
+            # responses dropped per method, their document had changed
+            stats['stale'] = self._client.staleResponseCounts()
+        stats['prefetch'] = dict(self._prefetch_stats)
+        stats['cache'] = self._results.counts()
+        return stats
+
     def on_server_connected(self):
         log.debug('event: backend is up')
         self._client.onInitialized()
         # wipe all exist documents
-        self._documents = {}
+        self._ForgetDocuments()
+        self._results.clear()
+        self._cursor_prefetch = None
 
     def on_server_down(self):
         log.debug('event: backend is down unexceptedly')
 
         self.lined_diagnostics = {}
-        vimsupport.ClearClangdSyntaxMatches()
-        vimsupport.UnplaceAllSigns()
+        self._diagnostics_renderer.clear()
 
         if not self._in_shutdown:
             self.stopServer(confirmed=True)
@@ -231,6 +338,7 @@ class ClangdManager(object):
 
         uri = GetUriFromFilePath(file_name)
         try:
+            self.FlushPendingChanges(vimsupport.GetBufferByName(file_name))
             self._client.didSaveTestDocument(uri)
         except TimedOutError:
             log.exception('unable to save %s' % file_name)
@@ -251,7 +359,10 @@ class ClangdManager(object):
         uri = GetUriFromFilePath(file_name)
         if not uri in self._documents:
             return
-        version = self._documents.pop(uri)['version']
+        document = self._ForgetDocument(uri)
+        self._diagnostics_renderer.forget(document['bufnr'])
+        # drawn again once the file is reopened
+        self.lined_diagnostics = {}
         try:
             self._client.didCloseTestDocument(uri)
         except TimedOutError:
@@ -309,18 +420,10 @@ class ClangdManager(object):
         # if we hit the cache, simple ignore
         if lined_diagnostics == self.lined_diagnostics:
             return diagnostics
-        # clean up current diagnostics
+        # only what changed is redrawn
         self.lined_diagnostics = lined_diagnostics
-        vimsupport.ClearClangdSyntaxMatches()
-        vimsupport.UnplaceAllSigns()
-
-        for diagnostic in diagnostics:
-            vimsupport.AddDiagnosticSyntaxMatch(
-                diagnostic['lnum'],
-                diagnostic['col'],
-                is_error=diagnostic['severity'] >= 3)
-
-        vimsupport.PlaceSignForErrorMessageArray(self.lined_diagnostics)
+        self._diagnostics_renderer.render(vimsupport.CurrentBuffer().number,
+                                          lined_diagnostics)
         return diagnostics
 
     def NearestDiagnostic(self, line, column):
@@ -377,12 +480,102 @@ class ClangdManager(object):
         if uri in self._documents:
             return
         file_type = buf.options['filetype'].decode('utf-8')
-        text = vimsupport.ExtractUTF8Text(buf)
+        lines = vimsupport.ExtractUTF8Lines(buf)
         self._documents[uri] = {}
         self._documents[uri]['version'] = 1
-        self._client.didOpenTestDocument(uri, text, file_type)
+        # shadow copy of what clangd sees
+        self._documents[uri]['lines'] = lines
+        self._documents[uri]['bufnr'] = buf.number
+        self._documents[uri]['listener'] = vimsupport.AddBufferListener(
+            buf.number)
+        if self._documents[uri]['listener']:
+            self._listened_buffers[buf.number] = uri
+        self._client.didOpenTestDocument(uri, '\n'.join(lines), file_type)
         log.debug('file %s opened' % file_name)
 
+    def _ForgetDocument(self, uri):
+        document = self._documents.pop(uri)
+        self._CancelScheduledChange(document)
+        self._results.invalidate(uri)
+        if document.get('listener'):
+            self._listened_buffers.pop(document['bufnr'], None)
+            vimsupport.RemoveBufferListener(document['listener'])
+        return document
+
+    def _ForgetDocuments(self):
+        for uri in list(self._documents.keys()):
+            self._ForgetDocument(uri)
+
+    def onBufferLinesChanged(self, bufnr, changes):
+        """Records a listener_add() report. changes are (lnum, end, added) in
+        the order they happened, lines lnum..end-1 (1-based) were replaced
+        and the line count changed by added."""
+        uri = self._listened_buffers.get(bufnr)
+        if not uri in self._documents:
+            return
+        document = self._documents[uri]
+        # vim's combined start, end and added don't describe one replaced
+        # range once edits are batched, each change is merged on its own
+        for start, end, added in changes:
+            self._MergeDirtyLines(document, start, end, added)
+
+    def _MergeDirtyLines(self, document, start, end, added):
+        # dirty span [lo, hi) in current buffer lines, delta is the line
+        # count change against the shadow copy
+        lo = start - 1
+        hi = end - 1 + added
+        if 'dirty' in document:
+            dirty_lo, dirty_hi, delta = document['dirty']
+            if dirty_hi >= end - 1:
+                dirty_hi += added
+            elif dirty_hi > lo:
+                # ends inside the replaced lines
+                dirty_hi = hi
+            lo = min(lo, dirty_lo)
+            hi = max(hi, dirty_hi)
+            added += delta
+        document['dirty'] = (lo, hi, added)
+
+    def _CollectListenedChanges(self, buf, document):
+        """Applies the dirty span to the shadow copy, reading only the
+        touched lines."""
+        vimsupport.FlushBufferListener(document['bufnr'])
+        if not 'dirty' in document:
+            return []
+        lo, hi, delta = document.pop('dirty')
+        lines = document['lines']
+        old_hi = hi - delta
+        if lo < 0 or lo > old_hi or old_hi > len(lines) or len(
+                lines) + delta != len(buf):
+            log.warn('lost track of %s, resync whole buffer' % buf.name)
+            new_lines = vimsupport.ExtractUTF8Lines(buf)
+            changes = ComputeContentChanges(lines, new_lines)
+            document['lines'] = new_lines
+            return changes
+        new_lines = vimsupport.ExtractUTF8Lines(buf, lo, hi)
+        if lines[lo:old_hi] == new_lines:
+            return []
+        change = ReplaceLinesChange(lines, lo, old_hi, new_lines)
+        lines[lo:old_hi] = new_lines
+        if change is None:
+            return None
+        return [change]
+
+    def _CollectChanges(self, buf, document):
+        """Brings the shadow copy up to date, returns the contentChanges or
+        None if a full sync is needed."""
+        if document.get('listener'):
+            return self._CollectListenedChanges(buf, document)
+        # no listener support, diff against a fresh snapshot
+        lines = vimsupport.ExtractUTF8Lines(buf)
+        if lines == document['lines']:
+            return []
+        changes = None
+        if self._incremental_sync:
+            changes = ComputeContentChanges(document['lines'], lines)
+        document['lines'] = lines
+        return changes
+
     def didChangeFile(self, buf):
         file_name = buf.name
         uri = GetUriFromFilePath(buf.name)
@@ -390,10 +583,70 @@ class ClangdManager(object):
             # not sure why this happens
             self.didOpenFile(buf)
             return
-        version = self._documents[uri][
-            'version'] = self._documents[uri]['version'] + 1
-        textbody = vimsupport.ExtractUTF8Text(buf)
-        self._client.didChangeTestDocument(uri, version, textbody)
+        document = self._documents[uri]
+        self._CancelScheduledChange(document)
+        changes = self._CollectChanges(buf, document)
+        if changes == []:
+            return
+        version = document['version'] = document['version'] + 1
+        self._results.invalidate(uri, version)
+        if changes is None or not self._incremental_sync:
+            self._client.didChangeTestDocument(uri, version,
+                                               '\n'.join(document['lines']))
+        else:
+            self._client.didChangeTestDocumentIncrementally(uri, version,
+                                                            changes)
+
+    def _ScheduleChange(self, buf):
+        """Sends didChange once buf stays untouched for the debounce
+        period, every edit restarts it."""
+        uri = GetUriFromFilePath(buf.name)
+        if not self._change_debounce_ms or not uri in self._documents:
+            self.didChangeFile(buf)
+            return
+        document = self._documents[uri]
+        self._CancelScheduledChange(document)
+        timer = vimsupport.StartTimer(self._change_debounce_ms,
+                                      'clangd#OnChangeTimer')
+        document['change_timer'] = timer
+        self._change_timers[timer] = uri
+
+    def _CancelScheduledChange(self, document):
+        timer = document.pop('change_timer', None)
+        if timer is None:
+            return
+        self._change_timers.pop(timer, None)
+        vimsupport.StopTimer(timer)
+
+    def onChangeTimer(self, timer):
+        uri = self._change_timers.pop(timer, None)
+        if not uri in self._documents:
+            return
+        document = self._documents[uri]
+        document.pop('change_timer', None)
+        buf = vimsupport.GetBufferByNumber(document['bufnr'])
+        if not buf or not self.isAlive():
+            return
+        try:
+            self.didChangeFile(buf)
+        except TimedOutError:
+            log.exception('failed to update %s' % buf.name)
+
+    def FlushPendingChanges(self, buf):
+        """Sends the debounced change of buf now, requests depending on the
+        text must see what the user sees."""
+        if not buf or not buf.name:
+            return
+        uri = GetUriFromFilePath(buf.name)
+        if not uri in self._documents:
+            return
+        document = self._documents[uri]
+        pending = 'change_timer' in document
+        if document.get('listener'):
+            vimsupport.FlushBufferListener(document['bufnr'])
+            pending = pending or 'dirty' in document
+        if pending:
+            self.didChangeFile(buf)
 
     def UpdateSpecifiedBuffer(self, buf):
         if not self.isAlive():
@@ -404,7 +657,7 @@ class ClangdManager(object):
         if not buf.options['modified']:
             if (len(buf) > 1) or (len(buf) == 1 and len(buf[0])):
                 return
-        self.didChangeFile(buf)
+        self._ScheduleChange(buf)
 
     def UpdateCurrentBuffer(self):
         if not self.isAlive():
@@ -430,38 +683,75 @@ class ClangdManager(object):
             return
         if uri != GetUriFromFilePath(vimsupport.CurrentBufferFileName()):
             return
-        if not self._last_completions_pos == (line, column):
+        session = self._completion_session
+        if not session or session['uri'] != uri or not session['pos'] == (
+                line, column):
             return
-        tries = self._GetEmptyCompletions()
-
-        log.debug('performed clang codecomplete at %d:%d, result %d items' %
-                (line, column, len(completions)))
-
-        for completion in completions:
+        log.debug('performed clang codecomplete at %d:%d' % (line, column))
+        self._IngestCompletions(session, completions)
+
+    def _IngestCompletions(self, session, completions):
+        # CompletionList or a plain CompletionItem[], which is complete
+        incomplete = False
+        if isinstance(completions, dict):
+            incomplete = completions.get('isIncomplete', False)
+            completions = completions.get('items', [])
+        indexes = self._GetEmptyCompletions()
+        fuzzy_entries = []
+        for n, completion in enumerate(completions):
             if not 'kind' in completion:
                 continue
             kind = CompletionItemKind(completion['kind'])
-            # insertText is missing from old clangd, we try to keep compatibility here
-            word = completion[
-                'insertText'] if 'insertText' in completion else completion[
-                    'label']
-            # description
-            info = completion[
-                'detail'] if 'detail' in completion else completion['label']
-            # actual results to feed vim
-            tries[kind].insert(
-                word,
-                {
-                    'word':  # The actual completion
-                    word,
-                    'kind':  # The type of completion, one character
-                    kind,
-                    'info': info,  # description
-                    'icase': 1,  # ignore case
-                    'dup': 1  # allow duplicates
-                })
+            word = _CompletionWord(completion)
+            # ranked by sortText, clangd's own order breaks ties. vim items
+            # are only built for what ends up in the popup
+            indexes[kind].insert(word, (completion.get('sortText', ''), n))
+            fuzzy_entries.append((word, n))
         # update cache
-        self._last_completions = tries
+        session['items'] = completions
+        session['indexes'] = indexes
+        # built here rather than on the first keystroke that needs it
+        session['fuzzy'] = FuzzyIndex(fuzzy_entries)
+        session['incomplete'] = incomplete
+        session['answered'] = True
+        if not incomplete:
+            self._results.put(self._CompletionKey(session), completions)
+
+    def _CompletionKey(self, session):
+        return (session['uri'], session['version'], Completion_REQUEST,
+                session['pos'])
+
+    def _CachedRequest(self, uri, method, position, request):
+        """Returns request() through the result cache, the document must
+        be synchronized already."""
+        if not uri in self._documents:
+            return request()
+        key = (uri, self._documents[uri]['version'], method, position)
+        result = self._results.get(key, _MISSING)
+        if result is _MISSING:
+            result = request()
+            self._results.put(key, result)
+        return result
+
+    def _CanRefineCompletions(self, uri, line, leading, prefix):
+        """Whether the last results still hold for prefix typed after the
+        leading text of line, so they can be filtered locally."""
+        session = self._completion_session
+        if not session or session['uri'] != uri:
+            return False
+        if session['line'] != line or session['leading'] != leading:
+            return False
+        if not session['answered']:
+            # still on its way, it is filtered once in. a request which ended
+            # without an answer is sent again
+            handle = session.get('handle')
+            if handle is None or handle.done():
+                return False
+            return prefix.startswith(session['prefix'])
+        if session['incomplete']:
+            # clangd dropped items for the old prefix
+            return session['prefix'] == prefix
+        return prefix.startswith(session['prefix'])
 
     def CodeCompleteAtCurrent(self):
         if not self.isAlive():
@@ -484,85 +774,387 @@ class ClangdManager(object):
         if not trigger_word in self._triggerCharacters:
             return -1
 
-        if not self._last_completions_pos == (line - 1, start_column):
-            timeout_ms = GetIntValue('g:clangd#codecomplete_timeout')
+        uri = GetUriFromFilePath(vimsupport.CurrentBufferFileName())
+        leading = vimsupport.CurrentLine()[:start_column]
+        self._DispatchCompletions()
+        refine = self._CanRefineCompletions(uri, line - 1, leading, start_word)
+        self._CountPrefetch(refine, start_word)
+        if not refine:
             try:
-                self._last_completions_pos = (line - 1, start_column)
-                uri = GetUriFromFilePath(vimsupport.CurrentBufferFileName())
-                self._client.codeCompleteAt(
-                    uri, line - 1, start_column, timeout_ms=timeout_ms)
+                self.FlushPendingChanges(vimsupport.CurrentBuffer())
             except TimedOutError:
-                log.warn('perform clang codecomplete timed out at %d:%d' %
-                         (line, column))
+                log.exception('failed to update curent buffer')
+                return -1
+            session = self._NewCompletionSession(uri, line - 1, leading,
+                                                 start_word)
+            character = session['pos'][1]
+            if session['answered']:
+                log.debug('codecomplete at %d:%d from cache' % (line, column))
+            elif self._async_completion:
+                return self._CodeCompleteAsync(uri, line - 1, character)
+            else:
+                timeout_ms = GetIntValue('g:clangd#codecomplete_timeout')
+                try:
+                    self._client.codeCompleteAt(
+                        uri, line - 1, character, timeout_ms=timeout_ms)
+                except TimedOutError as e:
+                    log.warn('perform clang codecomplete timed out at %d:%d' %
+                             (line, column))
+                    # the late response is filtered by the next keystrokes
+                    session['handle'] = e.future
+        elif not self._completion_session['answered']:
+            if self._async_completion:
+                # the popup is shown by the poll timer
+                self._StartCompletionPolling()
+                return -1
+            self._WaitForCompletions(
+                GetIntValue('g:clangd#codecomplete_timeout'))
 
         # fetch cachable completions
-        tries = self._last_completions
+        self._computed_completions_words = self._FilterCompletions(
+            self._completion_session, start_word)
+        return start_column + 1
 
-        flat_completions = []
-        for kind, trie in tries.items():
-            flat_completions.extend(trie.searchPrefix(start_word)[0:10])
+    def _NewCompletionSession(self, uri, line, leading, prefix,
+                              prefetched=False):
+        """Starts a session, answered right away if the result cache has
+        it. The document must be synchronized already."""
+        if self._completion_session and self._completion_session.get(
+                'prefetched'):
+            self._prefetch_stats['unused'] += 1
+        # ask at the end of the prefix, so clangd filters by it
+        self._completion_session = {
+            'uri': uri,
+            'version': self._documents[uri]['version'],
+            'line': line,
+            'leading': leading,
+            'start': len(leading),
+            'prefix': prefix,
+            'pos': (line, len(leading) + len(prefix)),
+            'incomplete': True,
+            'answered': False,
+            'prefetched': prefetched,
+            'indexes': self._GetEmptyCompletions(),
+            'fuzzy': FuzzyIndex([])
+        }
+        cached = self._results.get(self._CompletionKey(
+            self._completion_session))
+        if cached is not None:
+            self._IngestCompletions(self._completion_session, cached)
+        return self._completion_session
+
+    def _CountPrefetch(self, refine, prefix):
+        session = self._completion_session
+        if refine and session.get('prefetched'):
+            session['prefetched'] = False
+            if session['answered']:
+                self._prefetch_stats['hits'] += 1
+            else:
+                self._prefetch_stats['late'] += 1
+        elif not refine and not prefix:
+            # right after a trigger character, nothing was prefetched
+            self._prefetch_stats['misses'] += 1
+
+    def _DispatchCompletions(self):
+        # responses wait in the read queue until handleClientRequests
+        session = self._completion_session
+        if session and not session['answered'] and 'handle' in session:
+            if session['handle'].done():
+                self._client.handleClientRequests()
+
+    def _WaitForCompletions(self, timeout_ms):
+        handle = self._completion_session.get('handle')
+        if handle is None or not handle.wait(timeout_ms):
+            log.warn('pending codecomplete is not ready')
+            return
+        self._client.handleClientRequests()
 
-        self._computed_completions_words = flat_completions
-        return start_column + 1
+    def _IsTriggeredAt(self, line, start_column):
+        """Whether completion makes sense right after line[:start_column],
+        pickier than CodeCompleteAtCurrent since nobody asked yet."""
+        if not start_column:
+            return False
+        trigger_word = line[start_column - 1]
+        if not trigger_word in self._triggerCharacters:
+            return False
+        if trigger_word == '>':
+            return line[start_column - 2:start_column] == '->'
+        if trigger_word == ':':
+            return line[start_column - 2:start_column] == '::'
+        return True
+
+    def PrefetchCompletions(self):
+        """Requests completions in the background once a trigger character
+        is typed, so they are ready when the popup opens."""
+        if not self._prefetch_completions or not self.isAlive():
+            return
+        if vimsupport.CurrentMode() != 'i':
+            return
+        buf = vimsupport.CurrentBuffer()
+        if not buf.name:
+            return
+        uri = GetUriFromFilePath(buf.name)
+        if not uri in self._documents:
+            return
+        line, column = vimsupport.CurrentLineAndColumn()
+        current_line = vimsupport.CurrentLine()
+        start_column, start_word = self._CalculateStartColumnAt(
+            column, current_line)
+        if start_word or not self._IsTriggeredAt(current_line, start_column):
+            return
+        leading = current_line[:start_column]
+        if self._CanRefineCompletions(uri, line - 1, leading, start_word):
+            return
+        try:
+            self.FlushPendingChanges(buf)
+            session = self._NewCompletionSession(
+                uri, line - 1, leading, start_word, prefetched=True)
+            if session['answered']:
+                return
+            session['handle'] = self._client.codeCompleteAtAsync(
+                uri, line - 1, start_column)
+        except OSError:
+            log.exception('failed to prefetch completions at %d:%d' %
+                          (line, column))
+            self._completion_session = None
+
+    def _FilterCompletions(self, session, prefix):
+        matches = [
+            n for _, n in TopPrefixMatches(session['indexes'].values(),
+                                           prefix, COMPLETION_LIMIT)
+        ]
+        if prefix and len(matches) < COMPLETION_LIMIT:
+            # too few prefix matches, fill up with fuzzy ones
+            seen = set(matches)
+            for _, n in session['fuzzy'].match(prefix, COMPLETION_LIMIT):
+                if len(matches) >= COMPLETION_LIMIT:
+                    break
+                if not n in seen:
+                    matches.append(n)
+        return [_VimCompletionItem(session['items'][n]) for n in matches]
+
+    def _CodeCompleteAsync(self, uri, line, character):
+        """Sends the completion request and returns to vim right away, the
+        poll timer shows the popup when the response is in."""
+        try:
+            self._completion_session['handle'] = (
+                self._client.codeCompleteAtAsync(uri, line, character))
+        except OSError:
+            log.exception('failed to request completions at %d:%d' %
+                          (line, character))
+            return -1
+        self._StartCompletionPolling()
+        return -1
+
+    def _StartCompletionPolling(self):
+        if self._completion_timer is None:
+            self._completion_timer = vimsupport.StartTimer(
+                COMPLETION_POLL_MS, 'clangd#OnCompletionTimer', repeat=True)
+
+    def _StopCompletionPolling(self, cancel=False):
+        if self._completion_timer is not None:
+            vimsupport.StopTimer(self._completion_timer)
+            self._completion_timer = None
+        session = self._completion_session
+        if session and 'handle' in session:
+            handle = session.pop('handle')
+            if cancel and not session['answered']:
+                self._client.cancelRequest(handle)
+
+    def _CompletionStillWanted(self, session):
+        """Returns the typed prefix if the cursor is still in the identifier
+        completed by session, None otherwise."""
+        if vimsupport.CurrentMode() != 'i':
+            return None
+        uri = GetUriFromFilePath(vimsupport.CurrentBufferFileName())
+        line, column = vimsupport.CurrentLineAndColumn()
+        current_line = vimsupport.CurrentLine()
+        start_column, start_word = self._CalculateStartColumnAt(
+            column, current_line)
+        if session['uri'] != uri or session['line'] != line - 1:
+            return None
+        if session['leading'] != current_line[:start_column]:
+            return None
+        if not start_word.startswith(session['prefix']):
+            return None
+        return start_word
+
+    def onCompletionTimer(self):
+        """Returns [start column, words] for complete() once the pending
+        completion is answered."""
+        session = self._completion_session
+        if not session or not 'handle' in session or not self.isAlive():
+            self._StopCompletionPolling()
+            return None
+        self._client.handleClientRequests()
+        if not session['answered'] and session['handle'].done():
+            # failed, expired, cancelled or computed for an older text
+            log.debug('codecomplete at %d:%d ended without an answer' %
+                      session['pos'])
+            self._StopCompletionPolling()
+            self._completion_session = None
+            return None
+        prefix = self._CompletionStillWanted(session)
+        if prefix is None:
+            self._StopCompletionPolling(cancel=True)
+            return None
+        if not session['answered']:
+            return None
+        self._StopCompletionPolling()
+        words = self._FilterCompletions(session, prefix)
+        if not words:
+            return None
+        self._computed_completions_words = words
+        return [session['start'] + 1, words]
 
     def GetCompletions(self):
-        if len(self._last_completions) == 0:
+        if not self._completion_session:
             return {'words': [], 'refresh': 'always'}
         _, column = vimsupport.CurrentLineAndColumn()
         words = self._computed_completions_words
         return {'words': words, 'refresh': 'always'}
 
-    def GotoDefinition(self):
+    def _CursorPosition(self):
+        """Returns (uri, (line, character)) of the cursor, None if the current
+        file isn't opened."""
+        uri = GetUriFromFilePath(vimsupport.CurrentBufferFileName())
+        if not uri in self._documents:
+            return None
+        line, column = vimsupport.CurrentLineAndColumn()
+        return uri, (line - 1, column - 1)
+
+    def _CursorRequest(self, method, request):
+        """Returns the result of method at the cursor, from the prefetch
+        when it is in."""
+        if not self.OpenCurrentFile():
+            return None
+        self.FlushPendingChanges(vimsupport.CurrentBuffer())
+        cursor = self._CursorPosition()
+        if not cursor:
+            return None
+        uri, position = cursor
+        # pick up a prefetch answered since the last poll
+        self._client.handleClientRequests()
+        prefetch = self._cursor_prefetch
+        if prefetch and method in prefetch['handles']:
+            # asked before the prefetch made it, don't compute it twice
+            self._client.cancelRequest(prefetch['handles'].pop(method))
+        return self._CachedRequest(
+            uri, method, position,
+            lambda: request(uri, position[0], position[1]))
+
+    def PrefetchCursorInfo(self):
+        """Fetches the definition and hover of the symbol under the cursor in
+        the background, so that asking for them is answered from cache."""
+        if not self.isAlive() or vimsupport.CurrentMode() != 'n':
+            return
+        self.FlushPendingChanges(vimsupport.CurrentBuffer())
+        cursor = self._CursorPosition()
+        if not cursor:
+            return
+        uri, position = cursor
+        version = self._documents[uri]['version']
+        prefetch = self._cursor_prefetch
+        if prefetch and (prefetch['uri'], prefetch['version'],
+                         prefetch['position']) == (uri, version, position):
+            return
+        self.CancelCursorPrefetch(force=True)
+        prefetch = {
+            'uri': uri,
+            'version': version,
+            'position': position,
+            # method -> handle of the request on its way
+            'handles': {}
+        }
+        self._cursor_prefetch = prefetch
+        for method, request in ((Definition_REQUEST,
+                                 self._client.definitionAsync),
+                                (Hover_REQUEST, self._client.hoverAsync)):
+            if (uri, version, method, position) in self._results:
+                continue
+            callback = lambda result, method=method: self._OnCursorPrefetched(
+                prefetch, method, result)
+            try:
+                prefetch['handles'][method] = request(
+                    uri, position[0], position[1], callback)
+            except OSError:
+                log.exception('failed to prefetch %s at %d:%d' %
+                              (method, position[0], position[1]))
+                return
+
+    def _OnCursorPrefetched(self, prefetch, method, result):
+        prefetch['handles'].pop(method, None)
+        uri = prefetch['uri']
+        # failed, or computed for a text which is gone
+        if result is None or not uri in self._documents:
+            return
+        if self._documents[uri]['version'] != prefetch['version']:
+            return
+        self._results.put((uri, prefetch['version'], method,
+                           prefetch['position']), result)
+
+    def CancelCursorPrefetch(self, force=False):
+        """Drops the prefetch once the cursor has moved away from it."""
+        prefetch = self._cursor_prefetch
+        if not prefetch:
+            return
+        if not force and self._CursorPosition() == (prefetch['uri'],
+                                                     prefetch['position']):
+            return
+        self._cursor_prefetch = None
         if not self.isAlive():
             return
+        for handle in prefetch['handles'].values():
+            self._client.cancelRequest(handle)
+        prefetch['handles'].clear()
 
+    def GotoDefinition(self):
+        if not self.isAlive():
+            return
         line, column = vimsupport.CurrentLineAndColumn()
-        #TODO we may want to reparse source file actively here or by-pass the
-        # reparsing to incoming source file monitor?
-
-        response = self.wc.GetDefinition(vimsupport.CurrentBufferFileName(),
-                                         line, column)
-        if not response:
+        try:
+            response = self._CursorRequest(Definition_REQUEST,
+                                           self._client.definition)
+        except TimedOutError:
+            log.exception('definition timed out')
+            response = None
+        location = _DefinitionLocation(response)
+        if not location:
             log.warning('unable to get definition at %d:%d' % (line, column))
             vimsupport.EchoTruncatedText('unable to get definition at %d:%d' %
                                          (line, column))
             return
-        location = response.location
-        file_name = location.file_name
-        line = location.line
-        column = location.column
-        vimsupport.GotoBuffer(file_name, line, column)
+        uri, line, character = location
+        vimsupport.GotoBuffer(GetFilePathFromUri(uri), line + 1,
+                              character + 1)
 
     def ShowCursorDetail(self):
         if not self.isAlive():
             return
-
         line, column = vimsupport.CurrentLineAndColumn()
-        #TODO we may want to reparse source file actively here or by-pass the
-        # reparsing to incoming source file monitor?
-        response = self.wc.GetCursorDetail(vimsupport.CurrentBufferFileName(),
-                                           line, column)
-        if not response:
+        try:
+            response = self._CursorRequest(Hover_REQUEST, self._client.hover)
+        except TimedOutError:
+            log.exception('hover timed out')
+            response = None
+        message = _HoverText(response)
+        if not message:
             log.warning('unable to get cursor at %d:%d' % (line, column))
             vimsupport.EchoTruncatedText('unable to get cursor at %d:%d' %
                                          (line, column))
             return
-        detail = response.detail
-        message = 'Type: %s Kind: %s' % (detail.type, detail.kind)
-        brief_comment = detail.brief_comment
-        if brief_comment:
-            message += '   '
-            message += brief_comment
         vimsupport.EchoText(message)
 
     def CloseAllFiles(self):
-        if not self.isAlive():
-            return
         try:
-            for uri in list(self._documents.keys()):
-                self._client.didCloseTestDocument(uri)
+            if self.isAlive():
+                for uri in list(self._documents.keys()):
+                    self._client.didCloseTestDocument(uri)
         except TimedOutError:
             log.exception('failed to close all files')
+        # their listeners would report every change twice once the files
+        # are opened again
+        self._ForgetDocuments()
 
     def _UpdateBufferByTextEdits(self, buf, textedits):
         text = vimsupport.ExtractUTF8Text(buf)
@@ -617,7 +1209,9 @@ class ClangdManager(object):
             self.didChangeFile(buf)
 
             # actual format rpc
-            textedits = self._client.format(uri)
+            textedits = self._CachedRequest(
+                uri, Formatting_REQUEST, None,
+                lambda: self._client.format(uri))
         except TimedOutError:
             log.exception('code format timed out')
             vimsupport.EchoMessage('backend refuses to perform code format')
@@ -640,8 +1234,12 @@ class ClangdManager(object):
             self.didChangeFile(buf)
 
             # actual format rpc
-            textedits = self._client.rangeFormat(uri, start_line - 1, start_column,
-                                                 end_line - 1, end_column)
+            textedits = self._CachedRequest(
+                uri, RangeFormatting_REQUEST,
+                (start_line - 1, start_column, end_line - 1, end_column),
+                lambda: self._client.rangeFormat(
+                    uri, start_line - 1, start_column, end_line - 1,
+                    end_column))
         except TimedOutError:
             log.exception('code format')
             vimsupport.EchoMessage("clangd refuse to perform code format")
@@ -0,0 +1,152 @@
+# rendering of diagnostics as signs and highlights
+#
+# what is shown is remembered per buffer, so an update only places what is new
+# and removes what is gone instead of redrawing everything, which flickers in
+# files with hundreds of warnings.
+#
+# with text properties the highlights belong to the buffer and move along with
+# its text, and a whole update goes to vim in one call. older vims get a
+# matchadd() and a :sign command per item.
+from clangd import vimsupport
+
+# our signs live in their own group, other plugins' signs are never touched
+SIGN_GROUP = 'clangd'
+# text property types, defined along with the highlight groups of the same
+# name in autoload/clangd.vim
+PROP_TYPES = ['clangdErrorSection', 'clangdWarningSection']
+
+
+def _IsError(severity):
+    return severity >= 3
+
+
+def _SignName(severity):
+    return 'clangdError' if _IsError(severity) else 'clangdWarning'
+
+
+def _PropType(severity):
+    return PROP_TYPES[0] if _IsError(severity) else PROP_TYPES[1]
+
+
+class DiagnosticsRenderer(object):
+    def __init__(self):
+        self._batched = vimsupport.HasTextProperties()
+        self._sign_group = SIGN_GROUP if vimsupport.HasSignGroups() else None
+        # bufnr -> {(line, sign name): sign id}
+        self._signs = {}
+        # bufnr -> {(line, col, severity): text property id}
+        self._props = {}
+        self._next_id = 1
+        # matches belong to windows, window id -> (bufnr,
+        # {(line, col, severity): match id})
+        self._matches = {}
+
+    def _NextId(self):
+        next_id = self._next_id
+        self._next_id += 1
+        return next_id
+
+    def render(self, bufnr, lined_diagnostics):
+        """Shows lined_diagnostics, lists of diagnostics by line, in buffer
+        bufnr and the current window."""
+        signs = set()
+        highlights = set()
+        for line, diagnostics in lined_diagnostics.items():
+            # FIXME we should show most severity error
+            signs.add((line, _SignName(diagnostics[0]['severity'])))
+            for diagnostic in diagnostics:
+                highlights.add((line, diagnostic['col'],
+                                diagnostic['severity']))
+        if self._batched:
+            self._RenderBatched(bufnr, signs, highlights)
+            return
+        self._RenderSigns(bufnr, signs)
+        self._RenderMatches(bufnr, highlights)
+
+    def _RenderBatched(self, bufnr, signs, highlights):
+        placed = self._signs.setdefault(bufnr, {})
+        gone = [key for key in placed if not key in signs]
+        removed_signs = [placed.pop(key) for key in gone]
+        added_signs = []
+        for key in signs:
+            if not key in placed:
+                placed[key] = self._NextId()
+                added_signs.append([placed[key], key[0], key[1]])
+
+        props = self._props.setdefault(bufnr, {})
+        gone = [key for key in props if not key in highlights]
+        clear_types = []
+        removed_props = []
+        if len(gone) > len(props) - len(gone):
+            # lines moved, say. removing a property by id scans the buffer
+            # when it's not on its line anymore, starting over is cheaper
+            clear_types = PROP_TYPES
+            props.clear()
+        else:
+            # [id, line it was added on]
+            removed_props = [[props.pop(key), key[0]] for key in gone]
+        added_props = []
+        for key in highlights:
+            if not key in props:
+                line, column, severity = key
+                props[key] = self._NextId()
+                added_props.append([props[key], line, column,
+                                    _PropType(severity)])
+
+        if (removed_signs or added_signs or clear_types or removed_props or
+                added_props):
+            vimsupport.RenderDiagnostics(bufnr, SIGN_GROUP, clear_types,
+                                         removed_props, added_props,
+                                         removed_signs, added_signs)
+
+    def _RenderSigns(self, bufnr, wanted):
+        placed = self._signs.setdefault(bufnr, {})
+        for key in [key for key in placed if not key in wanted]:
+            vimsupport.UnplaceSign(placed.pop(key), bufnr, self._sign_group)
+        for key in wanted:
+            if key in placed:
+                continue
+            line, name = key
+            sign_id = self._NextId()
+            vimsupport.PlaceSign(sign_id, line, name, bufnr, self._sign_group)
+            placed[key] = sign_id
+
+    def _RenderMatches(self, bufnr, wanted):
+        window = vimsupport.CurrentWindowId()
+        shown_bufnr, added = self._matches.get(window, (bufnr, {}))
+        if shown_bufnr != bufnr:
+            # the window shows another buffer now, its highlights are wrong
+            for match_id in added.values():
+                vimsupport.DeleteSyntaxMatch(match_id)
+            added = {}
+        self._matches[window] = (bufnr, added)
+        for key in [key for key in added if not key in wanted]:
+            vimsupport.DeleteSyntaxMatch(added.pop(key))
+        for key in wanted:
+            if key in added:
+                continue
+            line, column, severity = key
+            added[key] = vimsupport.AddDiagnosticSyntaxMatch(
+                line, column, is_error=_IsError(severity))
+
+    def forget(self, bufnr):
+        """Removes what is shown in bufnr, whose file is closed."""
+        placed = self._signs.pop(bufnr, {})
+        props = self._props.pop(bufnr, {})
+        if not placed and not props:
+            return
+        if self._batched:
+            vimsupport.RenderDiagnostics(bufnr, SIGN_GROUP, PROP_TYPES, [], [],
+                                         list(placed.values()), [])
+        elif self._sign_group:
+            vimsupport.UnplaceSignGroup(bufnr, self._sign_group)
+        else:
+            for sign_id in placed.values():
+                vimsupport.UnplaceSign(sign_id, bufnr)
+
+    def clear(self):
+        for bufnr in set(self._signs.keys()) | set(self._props.keys()):
+            self.forget(bufnr)
+        if self._matches:
+            vimsupport.ClearClangdSyntaxMatches()
+            self._matches = {}
@@ -0,0 +1,81 @@
+# incremental text synchronization
+# https://github.com/Microsoft/language-server-protocol/blob/master/protocol.md#textDocument_didChange
+#
+# documents are kept as lists of lines, the same way vim buffers are, and a
+# change is described by replacing a run of whole lines.
+from clangd_support.python_utils import PY2
+
+# TextDocumentSyncKind
+SyncKind_NONE = 0
+SyncKind_FULL = 1
+SyncKind_INCREMENTAL = 2
+
+
+def Utf16Length(line):
+    """LSP positions count utf-16 code units."""
+    if PY2 and isinstance(line, str):
+        line = line.decode('utf-8')
+    return len(line.encode('utf-16-le')) // 2
+
+
+def _Position(line, character):
+    return {'line': line, 'character': character}
+
+
+def ReplaceLinesChange(old_lines, start, end, new_lines):
+    """Returns the contentChange replacing old_lines[start:end] by new_lines."""
+    if end < len(old_lines):
+        # followed by an untouched line, whole lines with their newline
+        return {
+            'range': {
+                'start': _Position(start, 0),
+                'end': _Position(end, 0)
+            },
+            'text': ''.join(line + '\n' for line in new_lines)
+        }
+    if start > 0:
+        # up to the end of document, starting after the previous line
+        last = len(old_lines) - 1
+        return {
+            'range': {
+                'start': _Position(start - 1, Utf16Length(old_lines[start - 1])),
+                'end': _Position(last, Utf16Length(old_lines[last]))
+            },
+            'text': ''.join('\n' + line for line in new_lines)
+        }
+    return None
+
+
+def DiffLines(old_lines, new_lines):
+    """Returns (start, old_end, new_end) of the changed run of lines, or None
+    if both are equal."""
+    old_len = len(old_lines)
+    new_len = len(new_lines)
+    limit = min(old_len, new_len)
+    start = 0
+    while start < limit and old_lines[start] == new_lines[start]:
+        start += 1
+    if start == old_len and start == new_len:
+        return None
+    suffix = 0
+    limit -= start
+    while suffix < limit and old_lines[old_len - suffix - 1] == new_lines[
+            new_len - suffix - 1]:
+        suffix += 1
+    return start, old_len - suffix, new_len - suffix
+
+
+def ComputeContentChanges(old_lines, new_lines):
+    """Returns the contentChanges turning old_lines into new_lines.
+
+    An empty list means there is nothing to send, None means a full sync is
+    cheaper, which happens when the change covers the whole document."""
+    diff = DiffLines(old_lines, new_lines)
+    if diff is None:
+        return []
+    start, old_end, new_end = diff
+    change = ReplaceLinesChange(old_lines, start, old_end,
+                                new_lines[start:new_end])
+    if change is None or new_end - start >= len(new_lines):
+        return None
+    return [change]
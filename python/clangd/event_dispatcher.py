@@ -107,12 +107,14 @@ class EventDispatcher(object):
     @check_loaded
     @check_timer
     def OnCursorMove(self):
+        self._manager.CancelCursorPrefetch()
         self._manager.EchoErrorMessageForCurrentLine()
 
     @check_loaded
     @check_timer
     def OnCursorHold(self):
         self._manager.EchoErrorMessageForCurrentLine()
+        self._manager.PrefetchCursorInfo()
 
     @check_loaded
     @check_timer
@@ -130,6 +132,22 @@ class EventDispatcher(object):
         # After a change was made to the text in the current buffer in Normal mode.
         log.debug('TextChanged')
         self._manager.UpdateCurrentBuffer()
+        self._manager.PrefetchCompletions()
+
+    @check_loaded
+    def OnBufferLinesChanged(self, bufnr, changes):
+        # reported by listener_add(), buffers must not be modified here
+        self._manager.onBufferLinesChanged(
+            bufnr, [(int(change['lnum']), int(change['end']),
+                     int(change['added'])) for change in changes])
+
+    @check_loaded
+    def OnChangeTimer(self, timer):
+        self._manager.onChangeTimer(timer)
+
+    @check_loaded
+    def OnCompletionTimer(self):
+        return self._manager.onCompletionTimer()
 
     @check_loaded
     def OnTimerCallback(self):
@@ -172,6 +190,20 @@ class EventDispatcher(object):
         log.info('GetCompletions')
         return self._manager.GetCompletions()
 
+    def GetStats(self):
+        if not self._loaded:
+            return {}
+        return self._manager.GetStats()
+
+    def EchoStats(self):
+        stats = self.GetStats()
+        lines = []
+        for group in sorted(stats.keys()):
+            counters = stats[group]
+            lines.append('%s: %s' % (group, ', '.join(
+                '%s %s' % (k, counters[k]) for k in sorted(counters.keys()))))
+        EchoText('\n'.join(lines) if lines else 'clangd is not running')
+
     @check_loaded
     @filter_current_file
     def GotoDefinition(self):
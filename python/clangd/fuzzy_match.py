@@ -0,0 +1,310 @@
+# fuzzy filtering of completion items, loosely after clangd's FuzzyMatch
+#
+# a pattern matches a word if its characters appear in order, ignoring case.
+# matches on segment heads (word start, after '_', a camelCase hump) score
+# higher, so `gfn` ranks getFileName above configFound.
+import re
+from bisect import bisect_left, bisect_right
+from clangd_support.python_utils import PY2
+from clangd.prefix_index import PrefixEnd
+
+HEAD_BONUS = 8
+CONSECUTIVE_BONUS = 4
+CASE_BONUS = 1
+PREFIX_BONUS = 6
+# on top, per character, for the word itself
+EXACT_BONUS = HEAD_BONUS
+GAP_PENALTY = 1
+
+
+def _ToText(word):
+    if PY2 and isinstance(word, str):
+        return word.decode('utf-8')
+    return word
+
+
+def _CharBit(c):
+    if 'a' <= c <= 'z':
+        return 1 << (ord(c) - ord('a'))
+    if '0' <= c <= '9':
+        return 1 << (26 + ord(c) - ord('0'))
+    return 1 << (36 + ord(c) % 27)
+
+
+# identifiers are lowercase letters and digits once lowered, those get a bit
+# of their own so a digit never passes for a letter
+_CHAR_BITS = dict((c, _CharBit(c)) for c in map(chr, range(128)))
+
+
+def CharMask(text):
+    """One bit per lowercase letter or digit, the other characters share the
+    remaining bits; a word can only match a pattern if it has all the
+    pattern's bits."""
+    mask = 0
+    for c in set(text):
+        bit = _CHAR_BITS.get(c)
+        mask |= bit if bit is not None else _CharBit(c)
+    return mask
+
+
+# SegmentHeads of an ascii word, in C
+_ASCII = re.compile(r'[\x00-\x7f]*\Z')
+_ASCII_HEAD = re.compile(r'^.|(?<=_)[^_]|(?<![A-Z])[A-Z]|(?<![0-9])[0-9]',
+                         re.DOTALL)
+
+
+def SegmentHeads(word):
+    """Returns the positions where a segment of word starts."""
+    if _ASCII.match(word):
+        return [m.start() for m in _ASCII_HEAD.finditer(word)]
+    heads = []
+    prev = ''
+    for i, c in enumerate(word):
+        if i == 0 or prev == '_' and c != '_':
+            heads.append(i)
+        elif c.isupper() and not prev.isupper():
+            heads.append(i)
+        elif c.isdigit() and not prev.isdigit():
+            heads.append(i)
+        prev = c
+    return heads
+
+
+def _HeadChars(candidate):
+    """The characters, lowered, candidate has on its heads."""
+    if _ASCII.match(candidate.word):
+        return frozenset(''.join(_ASCII_HEAD.findall(candidate.word)).lower())
+    lower = candidate.lower
+    return frozenset(lower[head] for head in candidate.heads
+                     if head < len(lower))
+
+
+def _Without(ids, lo, hi):
+    """Sorts ids, leaving out those from lo to hi."""
+    ids = sorted(ids)
+    return ids[:bisect_left(ids, lo)] + ids[bisect_left(ids, hi):]
+
+
+class _Candidate(object):
+    __slots__ = ('word', 'lower', 'mask', '_heads', '_head_set', 'data',
+                 'order')
+
+    def __init__(self, word, data, order=0):
+        self.word = word
+        self.lower = word.lower()
+        self.mask = CharMask(self.lower)
+        # most candidates are rejected by their mask, heads are found once
+        # one is matched
+        self._heads = None
+        self._head_set = None
+        self.data = data
+        # equal scores keep the order of the entries
+        self.order = order
+
+    @property
+    def heads(self):
+        if self._heads is None:
+            self._heads = SegmentHeads(self.word)
+        return self._heads
+
+    @property
+    def head_set(self):
+        if self._head_set is None:
+            self._head_set = frozenset(self.heads)
+        return self._head_set
+
+
+def _FindPositions(pattern, candidate):
+    """Matches pattern (lowercase) against candidate, jumping to segment
+    heads when they have the character."""
+    lower = candidate.lower
+    heads = candidate.heads
+    positions = []
+    start = 0
+    h = 0
+    for c in pattern:
+        while h < len(heads) and heads[h] < start:
+            h += 1
+        pos = -1
+        # prefer the character right here, then the next head having it
+        if start < len(lower) and lower[start] == c:
+            pos = start
+        else:
+            for head in heads[h:]:
+                if lower[head] == c:
+                    pos = head
+                    break
+        if pos < 0:
+            pos = lower.find(c, start)
+        if pos < 0:
+            return None
+        positions.append(pos)
+        start = pos + 1
+    return positions
+
+
+def _LeftmostPositions(pattern, lower):
+    positions = []
+    start = 0
+    for c in pattern:
+        pos = lower.find(c, start)
+        if pos < 0:
+            return None
+        positions.append(pos)
+        start = pos + 1
+    return positions
+
+
+def _MatchPositions(pattern, candidate):
+    # the leftmost match is cheap and rejects most candidates
+    leftmost = _LeftmostPositions(pattern, candidate.lower)
+    if leftmost is None:
+        return None
+    # jumping to a head may skip what the rest needs
+    return _FindPositions(pattern, candidate) or leftmost
+
+
+def _Score(pattern, positions, candidate):
+    heads = candidate.head_set
+    word = candidate.word
+    score = 0
+    last = -1
+    for i, pos in enumerate(positions):
+        if pos in heads:
+            score += HEAD_BONUS
+        if pos == last + 1 and last >= 0:
+            score += CONSECUTIVE_BONUS
+        elif last >= 0:
+            score -= min(pos - last - 1, 3) * GAP_PENALTY
+        if word[pos] == pattern[i]:
+            score += CASE_BONUS
+        last = pos
+    if positions[0] == 0:
+        score += PREFIX_BONUS
+    else:
+        score -= min(positions[0], 3) * GAP_PENALTY
+    if len(positions) == len(word):
+        # nothing scores like the word itself
+        score += EXACT_BONUS * len(positions)
+    # shorter words are closer to what was typed
+    return score * 64 - len(word)
+
+
+def FuzzyScore(pattern, word):
+    """Returns the match score of pattern in word, None if it doesn't match."""
+    candidate = _Candidate(_ToText(word), None)
+    pattern = _ToText(pattern)
+    positions = _MatchPositions(pattern.lower(), candidate)
+    if positions is None:
+        return None
+    return _Score(pattern, positions, candidate)
+
+
+class FuzzyIndex(object):
+    """Candidates prepared once per result set. Those likely to score best
+    are scored first, and scoring stops once limit of them match."""
+    def __init__(self, entries):
+        entries = [(_ToText(word), data) for word, data in entries]
+        # the shortest first, candidates are looked up by their position
+        ranked = sorted(range(len(entries)),
+                        key=lambda order: (len(entries[order][0]), order))
+        self._candidates = [_Candidate(entries[order][0], entries[order][1],
+                                       order) for order in ranked]
+        self._lengths = [len(candidate.word)
+                         for candidate in self._candidates]
+        self._masks = [candidate.mask for candidate in self._candidates]
+        # positions by lowered word, those starting with a pattern are next
+        # to each other
+        self._by_lower = sorted(range(len(self._candidates)),
+                                key=lambda i: self._candidates[i].lower)
+        self._lowers = [self._candidates[i].lower for i in self._by_lower]
+        # lowered character -> positions of the candidates starting with it,
+        # or having it on a head
+        self._first_chars = {}
+        self._head_chars = {}
+        for i, candidate in enumerate(self._candidates):
+            if candidate.lower:
+                self._first_chars.setdefault(candidate.lower[0],
+                                             set()).add(i)
+            for c in _HeadChars(candidate):
+                self._head_chars.setdefault(c, set()).add(i)
+        self._last_pattern = None
+        self._last_matches = []
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def _Ordered(self, lower_pattern, mask):
+        """Yields the positions of the candidates that may match, once each,
+        roughly by what the best of them could score: the word itself, words
+        starting with the pattern, words starting with its first character
+        or having all its characters on heads, then the rest. Shortest first
+        within each."""
+        n = len(lower_pattern)
+        # words of the pattern's length, only these can match entirely
+        lo = bisect_left(self._lengths, n)
+        hi = bisect_right(self._lengths, n)
+        for i in range(lo, hi):
+            yield i
+        first = self._first_chars.get(lower_pattern[0], frozenset())
+        sets = sorted((self._head_chars.get(c, frozenset())
+                       for c in set(lower_pattern)), key=len)
+        on_heads = sets[0].intersection(*sets[1:])
+        if n > 1:
+            start = bisect_left(self._lowers, lower_pattern)
+            end = PrefixEnd(lower_pattern)
+            stop = (bisect_left(self._lowers, end, start)
+                    if end is not None else len(self._lowers))
+            prefix = set(self._by_lower[start:stop])
+        else:
+            prefix = first
+        for tier in (lambda: prefix & on_heads, lambda: prefix - on_heads,
+                     lambda: (first & on_heads) - prefix,
+                     lambda: on_heads - first,
+                     lambda: first - on_heads - prefix):
+            for i in _Without(tier(), lo, hi):
+                yield i
+        ids = range(len(self._candidates))
+        if self._last_pattern is not None and lower_pattern.startswith(
+                self._last_pattern):
+            # whatever matches the longer pattern matched the shorter one
+            ids = self._last_matches
+        masks = self._masks
+        kept = []
+        for i in ids:
+            if masks[i] & mask == mask:
+                kept.append(i)
+                if not (lo <= i < hi or i in first or i in on_heads):
+                    yield i
+        # every candidate was looked at, the next pattern can start from
+        # those having this one's characters
+        self._last_pattern = lower_pattern
+        self._last_matches = kept
+
+    def match(self, pattern, limit):
+        """Returns up to limit (score, data) with the best score first."""
+        pattern = _ToText(pattern)
+        lower_pattern = pattern.lower()
+        if not lower_pattern or limit <= 0:
+            return []
+        mask = CharMask(lower_pattern)
+        candidates = self._candidates
+        lengths = self._lengths
+        # (score, -order, data)
+        matches = []
+        for i in self._Ordered(lower_pattern, mask):
+            # the words of the pattern's length come first, matching they
+            # beat the rest but not each other
+            if len(matches) >= limit and lengths[i] != len(lower_pattern):
+                break
+            candidate = candidates[i]
+            # the mask test rejects most candidates before any scanning
+            if candidate.mask & mask != mask:
+                continue
+            positions = _MatchPositions(lower_pattern, candidate)
+            if positions is None:
+                continue
+            matches.append((_Score(pattern, positions, candidate),
+                            -candidate.order, candidate.data))
+        matches.sort(key=lambda match: match[:2], reverse=True)
+        return [(score, data) for score, _, data in matches[:limit]]
@@ -13,9 +13,13 @@
 #
 import json
 import os
+from collections import deque, OrderedDict
+from itertools import islice
 from sys import platform as sys_platform
 from clangd import glog as log
-from threading import Thread
+from clangd_support.python_utils import monotonic
+from clangd.streaming_json import StreamingResponseDecoder, FIELD, RESULT, RESULT_FIELD, RESULT_ITEMS, RESULT_ITEM
+from threading import Thread, Event, Lock
 from time import sleep
 # try to keep compatibily with old 2.7
 try:
@@ -25,93 +29,681 @@ except ImportError:
 
 # platform specific
 if sys_platform == 'win32':
-    from clangd_support.poller import Win32Poller as Poller
-    from clangd_support.win32_utils import SetNonBlock, EstimateUnreadBytes, WriteUtf8, ReadUtf8
+    from clangd_support.poller import Win32Poller as Poller, POLLIN, POLLOUT
+    from clangd_support.win32_utils import SetNonBlock, EstimateUnreadBytes, WriteVectored, ReadBytes
 else:
-    from clangd_support.poller import PosixPoller as Poller
-    from clangd_support.posix_utils import SetNonBlock, EstimateUnreadBytes, WriteUtf8, ReadUtf8
+    from clangd_support.poller import PosixPoller as Poller, POLLIN, POLLOUT
+    from clangd_support.posix_utils import SetNonBlock, EstimateUnreadBytes, WriteVectored, ReadBytes
 
 DEFAULT_TIMEOUT_MS = 1000
-IDLE_INTERVAL_MS = 25
-MAX_IDLE_TIMES = 10
+DEFAULT_PENDING_TTL_MS = 60 * 1000
+MAX_PENDING_REQUESTS = 1024
+EXPIRE_INTERVAL_MS = 1000
+CancelRequest_NOTIFICATION = '$/cancelRequest'
+DidOpenTextDocument_NOTIFICATION = 'textDocument/didOpen'
+DidChangeTextDocument_NOTIFICATION = 'textDocument/didChange'
+DidCloseTextDocument_NOTIFICATION = 'textDocument/didClose'
+MAX_WRITE_CHUNKS = 64
+WRITE_LOW_WATERMARK_BYTES = 64 * 1024
+
+# bodies larger than this are decoded incrementally
+STREAMING_RESPONSE_BYTES = 64 * 1024
+# items decoded before a partial result is published
+PARTIAL_RESULT_ITEMS = 100
+# items decoded between two GIL releases
+ITEMS_PER_SLICE = 256
+# leading bytes of an incomplete body searched for those items
+PARTIAL_PEEK_BYTES = 256 * 1024
+
+# http://www.jsonrpc.org/specification#error_object
+MethodNotFound_ERROR = -32601
+InternalError_ERROR = -32603
+# lsp, the document changed since the request was sent
+ContentModified_ERROR = -32801
+MAX_HEADER_BYTES = 4096
+# consumed bytes are released once they exceed this and half of the buffer
+COMPACT_THRESHOLD_BYTES = 64 * 1024
 
 class TimedOutError(OSError):
-    pass
-
-def isNumber(c):
-    return ord('0') <= ord(c) and ord(c) <= ord('9')
-
-class JsonRPCClientThread(Thread):
-    def __init__(self, input_fd, output_fd, read_queue, write_queue):
-        Thread.__init__(self)
+    def __init__(self, message, future=None):
+        super(TimedOutError, self).__init__(message)
+        # the request still on its way, if any
+        self.future = future
+
+class MessageFramer(object):
+    """Incremental parser for Content-Length framed messages.
+
+    Raw bytes are accumulated in a bytearray and consumed through a read
+    offset, so parsing a message never copies the remaining stream; only
+    complete message bodies are decoded."""
+    HEADER_END = b'\r\n\r\n'
+    CONTENT_LENGTH = b'content-length'
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self._body_len = None
+        self._index = 0
+
+    def feed(self, data):
+        self._buf += data
+
+    def pending(self):
+        return len(self._buf) - self._pos
+
+    def messageIndex(self):
+        """Index of the message being received."""
+        return self._index
+
+    def partialBody(self, max_bytes):
+        """Returns the leading bytes of an incomplete body, decoded, along
+        with the full body length."""
+        if self._body_len is None or self.pending() >= self._body_len:
+            return None, 0
+        end = self._pos + min(self.pending(), max_bytes)
+        # a multi-byte character may be cut at the end
+        return self._buf[self._pos:end].decode('utf-8', 'ignore'), self._body_len
+
+    def _ParseHeaders(self, end):
+        length = None
+        for header in bytes(self._buf[self._pos:end]).split(b'\r\n'):
+            name, sep, value = header.partition(b':')
+            if not sep:
+                raise OSError('bad protocol')
+            if name.strip().lower() != self.CONTENT_LENGTH:
+                continue
+            value = value.strip()
+            if not value.isdigit() or len(value) > 19:
+                raise OSError('bad protocol')
+            length = int(value)
+        if length is None:
+            raise OSError('bad protocol')
+        return length
+
+    def _Compact(self):
+        if self._pos == len(self._buf):
+            del self._buf[:]
+            self._pos = 0
+        elif self._pos >= COMPACT_THRESHOLD_BYTES and self._pos * 2 >= len(
+                self._buf):
+            del self._buf[:self._pos]
+            self._pos = 0
+
+    def nextMessage(self):
+        """Returns the next decoded message body, or None if incomplete."""
+        if self._body_len is None:
+            end = self._buf.find(self.HEADER_END, self._pos)
+            if end < 0:
+                if self.pending() > MAX_HEADER_BYTES:
+                    raise OSError('bad protocol')
+                return None
+            self._body_len = self._ParseHeaders(end)
+            self._pos = end + len(self.HEADER_END)
+        if self.pending() < self._body_len:
+            return None
+        start = self._pos
+        self._pos += self._body_len
+        self._body_len = None
+        self._index += 1
+        try:
+            body = self._buf[start:self._pos].decode('utf-8')
+        except UnicodeDecodeError:
+            raise OSError('bad protocol')
+        self._Compact()
+        return body
+
+def _DocumentUri(r):
+    params = r['params']
+    if isinstance(params, dict) and 'textDocument' in params:
+        return params['textDocument'].get('uri')
+    return None
+
+def MergeContentChanges(older, newer):
+    """Concatenates two contentChanges lists, a full-text change drops all
+    changes before it."""
+    changes = older + newer
+    for i in range(len(changes) - 1, -1, -1):
+        if not 'range' in changes[i]:
+            return changes[i:]
+    return changes
+
+class OutgoingQueue(object):
+    """Messages waiting for serialization by the io thread.
+
+    A didChange notification replaces a pending didChange for the same
+    document in place, as long as no other message for that document was
+    queued after it."""
+    def __init__(self):
+        self._lock = Lock()
+        self._messages = deque()
+        # uri -> last pending message for that document
+        self._last_by_uri = {}
+        self._coalesced = 0
+        self._closing = False
+
+    def coalescedCount(self):
+        return self._coalesced
+
+    def isClosing(self):
+        return self._closing
+
+    def put(self, r):
+        with self._lock:
+            if r is None:
+                self._closing = True
+            uri = _DocumentUri(r) if r is not None else None
+            if uri is None:
+                self._messages.append(r)
+                return
+            last = self._last_by_uri.get(uri)
+            if (last is not None and
+                    last['method'] == DidChangeTextDocument_NOTIFICATION and
+                    r['method'] == DidChangeTextDocument_NOTIFICATION):
+                last['params']['textDocument'] = r['params']['textDocument']
+                last['params']['contentChanges'] = MergeContentChanges(
+                    last['params']['contentChanges'],
+                    r['params']['contentChanges'])
+                self._coalesced += 1
+                return
+            self._last_by_uri[uri] = r
+            self._messages.append(r)
+
+    def takeAll(self):
+        with self._lock:
+            messages = self._messages
+            self._messages = deque()
+            self._last_by_uri = {}
+        return messages
+
+class RequestHandlerRegistry(object):
+    """Handlers for server-initiated requests, run on the io thread.
+
+    A handler takes the request params and returns the result; it must not
+    touch vim. Unknown methods are answered with MethodNotFound."""
+    def __init__(self):
+        self._lock = Lock()
+        self._handlers = {}
+
+    def register(self, method, handler):
+        with self._lock:
+            self._handlers[method] = handler
+
+    def unregister(self, method):
+        with self._lock:
+            self._handlers.pop(method, None)
+
+    def handle(self, request):
+        method = request['method']
+        with self._lock:
+            handler = self._handlers.get(method)
+        response = {'jsonrpc': '2.0', 'id': request['id']}
+        if handler is None:
+            log.warn('unhandled request: %s' % method)
+            response['error'] = {
+                'code': MethodNotFound_ERROR,
+                'message': 'method not found: %s' % method
+            }
+            return response
+        try:
+            response['result'] = handler(request.get('params'))
+        except Exception as e:
+            log.exception('failed to handle request: %s' % method)
+            response['error'] = {
+                'code': InternalError_ERROR,
+                'message': str(e)
+            }
+        return response
+
+class PartialResponse(object):
+    """Queued for requests whose first result items were decoded before the
+    rest of a large response."""
+    def __init__(self, response):
+        self.response = response
+
+class RequestFuture(object):
+    """A pending request, resolved by the io thread when its response lands.
+
+    A waiter that gives up abandons the future; the response is then routed
+    through the read queue like any other incoming message. Asynchronous
+    requests start abandoned and get their callback invoked from there."""
+    def __init__(self, Id, method, context=None, callback=None,
+                 abandoned=False, partial=False, versioned=False):
+        # only minimal metadata is kept, never the request params
+        self.Id = Id
+        self.method = method
+        self.context = context
+        self.callback = callback
+        self.created = monotonic()
+        self.acceptsPartial = partial
+        # document version the request was computed against
+        self.uri = None
+        self.version = None
+        self._event = Event()
+        self._lock = Lock()
+        self._response = None
+        self._partial = None
+        self._abandoned = abandoned
+
+    def requestId(self):
+        return self.Id
+
+    def isAbandoned(self):
+        return self._abandoned
+
+    def done(self):
+        return self._event.is_set()
+
+    def response(self):
+        return self._response
+
+    def partialResponse(self):
+        return self._partial
+
+    def wait(self, timeout_ms):
+        return self._event.wait(timeout_ms * 0.001)
+
+    def abandon(self):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._abandoned = True
+            return True
+
+    def setPartialResponse(self, rr):
+        """Returns False if nobody waits for the response any more."""
+        with self._lock:
+            self._partial = rr
+            return not self._abandoned
+
+    def setResponse(self, rr):
+        """Returns False if nobody waits for the response any more, the
+        future is then done once finish() is called."""
+        with self._lock:
+            self._response = rr
+            if self._abandoned:
+                return False
+            self._event.set()
+            return True
+
+    def finish(self):
+        # an abandoned future is done only after its response is queued, so
+        # whoever sees it done finds the response in handleRecv
+        self._event.set()
+
+class PendingRequestTable(object):
+    """Bounded table of in-flight and cancelled requests shared with the io
+    thread.
+
+    Requests nobody waits for expire after ttl_ms, and the oldest of them
+    are evicted once the table holds max_size entries, so lost responses
+    can't leak memory."""
+    def __init__(self, ttl_ms=DEFAULT_PENDING_TTL_MS,
+                 max_size=MAX_PENDING_REQUESTS):
+        self._ttl = ttl_ms * 0.001
+        self._max_size = max_size
+        self._lock = Lock()
+        # id -> RequestFuture, in request order
+        self._pending = OrderedDict()
+        # id -> cancellation time
+        self._cancelled = OrderedDict()
+        # uri -> version last sent to the server
+        self._versions = {}
+        # method -> responses dropped for a changed document
+        self._stale = {}
+        self._last_expire = monotonic()
+        self._expired = 0
+        self._evicted = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, future):
+        with self._lock:
+            self._pending[future.Id] = future
+
+    def get(self, Id):
+        with self._lock:
+            return self._pending.get(Id)
+
+    def pop(self, Id):
+        with self._lock:
+            return self._pending.pop(Id, None)
+
+    def futures(self):
+        with self._lock:
+            return list(self._pending.values())
+
+    def markCancelled(self, Id):
+        with self._lock:
+            self._cancelled[Id] = monotonic()
+
+    def unmarkCancelled(self, Id):
+        """Returns True if the id was cancelled."""
+        with self._lock:
+            return self._cancelled.pop(Id, None) is not None
+
+    def setDocumentVersion(self, uri, version):
+        self._versions[uri] = version
+
+    def forgetDocument(self, uri):
+        self._versions.pop(uri, None)
+
+    def tagDocumentVersion(self, future, uri):
+        if uri in self._versions:
+            future.uri = uri
+            future.version = self._versions[uri]
+
+    def isStale(self, future):
+        """Whether the document of future changed since it was sent."""
+        return future.uri is not None and self._versions.get(
+            future.uri) != future.version
+
+    def countStale(self, method):
+        with self._lock:
+            self._stale[method] = self._stale.get(method, 0) + 1
+
+    def staleCounts(self):
+        with self._lock:
+            return dict(self._stale)
+
+    def expire(self, force=False):
+        """Drops stale entries and returns the expired futures."""
+        now = monotonic()
+        if not force and now - self._last_expire < EXPIRE_INTERVAL_MS * 0.001:
+            return []
+        self._last_expire = now
+        deadline = now - self._ttl
+        expired = []
+        with self._lock:
+            for Id, future in list(self._pending.items()):
+                # waiters have their own deadline
+                if not future.isAbandoned():
+                    continue
+                if (future.created > deadline and
+                        len(self._pending) <= self._max_size):
+                    break
+                if future.created > deadline:
+                    self._evicted += 1
+                else:
+                    self._expired += 1
+                expired.append(self._pending.pop(Id))
+            for Id, cancelled in list(self._cancelled.items()):
+                if cancelled > deadline and len(
+                        self._cancelled) <= self._max_size:
+                    break
+                self._cancelled.pop(Id)
+        return expired
+
+    def counts(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'cancelled': len(self._cancelled),
+                'expired': self._expired,
+                'evicted': self._evicted,
+            }
+
+class JsonRPCConnection(object):
+    """Per-server state driven by the reactor thread."""
+    def __init__(self, input_fd, output_fd, read_queue, write_queue, requests,
+                 handlers):
         self._is_stop = False
         self._input_fd = input_fd
         self._output_fd = output_fd
         self._read_queue = read_queue
+        self._requests = requests
+        self._handlers = handlers
         self._write_queue = write_queue
-        self._writebuf = u''
-        self._readbuf = u''
+        # encoded chunks, the first one is written from _write_offset
+        self._write_chunks = deque()
+        self._write_offset = 0
+        self._write_pending = 0
+        self._framer = MessageFramer()
+        self._partial_published = None
+        self._peeked_index = None
+        self._closed = Event()
         SetNonBlock(input_fd)
         SetNonBlock(output_fd)
-        self._poller = Poller([self._output_fd], [])
 
-    def shutdown(self):
-        log.warn('io thread shutdown')
-        self._poller.shutdown()
+    def readFd(self):
+        return self._output_fd
+
+    def writeFd(self):
+        return self._input_fd
+
+    def isStopped(self):
+        return self._is_stop
+
+    def wantsWrite(self):
+        return not self._is_stop and self._write_pending > 0
+
+    def close(self):
+        self._is_stop = True
+        self._closed.set()
+
+    def waitClosed(self):
+        self._closed.wait()
 
     def _FlushSendBuffer(self):
-        while self._writebuf:
-            written = WriteUtf8(self._input_fd, self._writebuf)
+        chunks = self._write_chunks
+        while chunks:
+            buffers = [memoryview(chunk) for chunk in islice(chunks, MAX_WRITE_CHUNKS)]
+            if self._write_offset:
+                buffers[0] = buffers[0][self._write_offset:]
+            written = WriteVectored(self._input_fd, buffers)
             if not written:
                 break
-            self._writebuf = self._writebuf[written:]
-            log.debug('written %d bytes remains %d bytes' % (written, len(self._writebuf)))
+            self._write_pending -= written
+            log.debug('written %d bytes remains %d bytes' % (written, self._write_pending))
+            consumed = written + self._write_offset
+            while chunks and consumed >= len(chunks[0]):
+                consumed -= len(chunks.popleft())
+            self._write_offset = consumed
 
     def _FetchRecvBuffer(self, buffer_len = 256):
         while buffer_len:
-            chunk = ReadUtf8(self._output_fd, buffer_len)
+            chunk = ReadBytes(self._output_fd, buffer_len)
             if not chunk:
                 break
             log.debug('read %d bytes with buffer %d bytes' % (len(chunk), buffer_len))
             buffer_len -= len(chunk)
-            self._readbuf += chunk
+            self._framer.feed(chunk)
 
     def _SendMsg(self, r):
-        request = json.dumps(r, separators=(',', ':'), sort_keys=True)
-        self._writebuf += u'Content-Length: %d\r\n\r\n' % len(request)
-        self._writebuf += request
-
-    def _RecvMsg(self):
-        PREFIX = 'Content-Length: '
-        if len(self._readbuf) < len(PREFIX):
-            return None
-        if not self._readbuf.startswith(PREFIX):
-            raise OSError('bad protocol')
-        i = len(PREFIX)
-        while i < len(self._readbuf):
-            if i - len(PREFIX) >= 23:  # sys.maxint + 4
-                raise OSError('bad protocol')
-            if not isNumber(self._readbuf[i]):
-                break
-            i += 1
-        if len(self._readbuf) < i + 4:
-            return None
-        if self._readbuf[i:i + 4] != u'\r\n\r\n':
-            raise OSError('bad protocol')
-        length = int(self._readbuf[len(PREFIX):i])
-        if len(self._readbuf) < i + 4 + length:
-            return None
-        msg = self._readbuf[i + 4:i + 4 + length]
+        # ascii-only thanks to ensure_ascii, encoded exactly once
+        request = json.dumps(r, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        header = ('Content-Length: %d\r\n\r\n' % len(request)).encode('utf-8')
+        self._write_chunks.append(header)
+        self._write_chunks.append(request)
+        self._write_pending += len(header) + len(request)
+
+    def _DecodeMsg(self, msg):
         try:
-            rr = json.loads(msg)
-        except Exception:
+            if len(msg) >= STREAMING_RESPONSE_BYTES:
+                return self._DecodeLargeMsg(msg)
+            return json.loads(msg)
+        except ValueError:
             raise OSError('bad protocol')
-        self._readbuf = self._readbuf[i + 4 + length:]
+
+    def _WalkLargeMsg(self, msg, peek):
+        """Decodes a large message item by item, publishing the leading items
+        of a partial-accepting request. With peek the body may be truncated,
+        nothing is consumed and walking stops once the items are published."""
+        rr = {}
+        result = None
+        items = None
+        future = None
+        for kind, key, value in StreamingResponseDecoder(msg).events():
+            if kind == FIELD:
+                rr[key] = value
+            elif kind == RESULT:
+                if peek:
+                    future = self._requests.get(rr.get('id'))
+                    if not future or not future.acceptsPartial:
+                        return None
+                    if self._requests.isStale(future):
+                        return None
+                elif self._requests.unmarkCancelled(rr.get('id')):
+                    log.debug('drop response of cancelled request %s' %
+                              rr['id'])
+                    return None
+                else:
+                    future = self._requests.get(rr.get('id'))
+                    if future and self._requests.isStale(future):
+                        # the result is never decoded
+                        return self._StaleResponse(future)
+                if value == 'list':
+                    result = items = []
+                else:
+                    result = {}
+            elif kind == RESULT_FIELD:
+                result[key] = value
+            elif kind == RESULT_ITEMS:
+                result[key] = items = []
+            elif kind == RESULT_ITEM:
+                items.append(value)
+                if (len(items) == PARTIAL_RESULT_ITEMS and future and
+                        future.acceptsPartial and
+                        self._partial_published != rr['id']):
+                    self._partial_published = rr['id']
+                    self._PublishPartial(future, rr['id'], result, items)
+                    if peek:
+                        return None
+                if len(items) % ITEMS_PER_SLICE == 0:
+                    # let the vim main thread run
+                    sleep(0)
+        if result is not None:
+            rr['result'] = result
+        return rr
+
+    def _DecodeLargeMsg(self, msg):
+        rr = self._WalkLargeMsg(msg, peek=False)
+        self._partial_published = None
         return rr
 
-    def _OnWentWrong(self):
+    def _PeekLargeMsg(self):
+        """Publishes the leading result items of an incomplete large body."""
+        if self._framer.messageIndex() == self._peeked_index:
+            return
+        body, length = self._framer.partialBody(PARTIAL_PEEK_BYTES)
+        if body is None or length < STREAMING_RESPONSE_BYTES:
+            return
+        try:
+            self._WalkLargeMsg(body, peek=True)
+        except ValueError:
+            # truncated, retry with more data
+            pass
+        if self._partial_published is not None or len(
+                body) >= PARTIAL_PEEK_BYTES:
+            self._peeked_index = self._framer.messageIndex()
+
+    def _PublishPartial(self, future, Id, result, items):
+        if isinstance(result, dict):
+            partial = dict(result)
+            partial['items'] = list(items)
+            partial['isIncomplete'] = True
+        else:
+            partial = list(items)
+        rr = {'id': Id, 'result': partial}
+        if not future.setPartialResponse(rr):
+            self._read_queue.put(PartialResponse(rr))
+
+    def _StaleResponse(self, future):
+        """Replaces the response to a request whose document changed."""
+        log.debug('drop stale response of %s %s' % (future.method, future.Id))
+        self._requests.countStale(future.method)
+        return {
+            'jsonrpc': '2.0',
+            'id': future.Id,
+            'error': {
+                'code': ContentModified_ERROR,
+                'message': 'document changed'
+            }
+        }
+
+    def _OnMessage(self, rr):
+        if rr is None:
+            return
+        if 'id' in rr and 'method' in rr:
+            log.info('recv request: %s' % rr['method'])
+            # answer right away, the vim main thread is not involved
+            self._SendMsg(self._handlers.handle(rr))
+            return
+        future = None
+        if 'id' in rr and not 'method' in rr:
+            if self._requests.unmarkCancelled(rr['id']):
+                log.debug('drop response of cancelled request %s' % rr['id'])
+                return
+            future = self._requests.get(rr['id'])
+            if future and 'result' in rr and self._requests.isStale(future):
+                rr = self._StaleResponse(future)
+            if future and future.setResponse(rr):
+                return
+        self._read_queue.put(rr)
+        if future:
+            future.finish()
+
+    def onWentWrong(self):
         self._is_stop = True
         self._read_queue.put(OSError('shutdown unexcepted'))
+        # wake up all waiters
+        for future in self._requests.futures():
+            future.setResponse(None)
+            future.finish()
+
+    def onReadable(self):
+        buffer_len = EstimateUnreadBytes(self._output_fd)
+        # ticky to detect clangd's failure
+        if buffer_len == 0:
+            self.onWentWrong()
+            return
+        self._FetchRecvBuffer(buffer_len)
+        try:
+            msg = self._framer.nextMessage()
+            while msg is not None:
+                self._OnMessage(self._DecodeMsg(msg))
+                msg = self._framer.nextMessage()
+            self._PeekLargeMsg()
+            # flush responses to server requests
+            self._FlushSendBuffer()
+        except OSError as e:
+            self.onWentWrong()
+
+    def onWritable(self):
+        try:
+            self._FlushSendBuffer()
+            # keep messages queued while the pipe is backed up, so pending
+            # didChange notifications can still be coalesced
+            if (self._write_pending >= WRITE_LOW_WATERMARK_BYTES and
+                    not self._write_queue.isClosing()):
+                return
+            for r in self._write_queue.takeAll():
+                # receive shutdown sentinel
+                if r == None:
+                    self._is_stop = True
+                    break
+                self._SendMsg(r)
+            self._FlushSendBuffer()
+        except OSError as e:
+            self.onWentWrong()
+
+class JsonRPCReactor(Thread):
+    """Single io thread multiplexing every clangd connection.
+
+    Connections are woken up through the poller's self-pipe whenever a
+    message is enqueued, so the loop never polls with an idle timeout."""
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._poller = Poller()
+        self._lock = Lock()
+        self._pending = set()
+        self._connections = {}
+
+    def notify(self, connection):
+        with self._lock:
+            self._pending.add(connection)
+        self._poller.wakeup()
 
     def run(self):
         log.warn('io thread starts')
@@ -119,66 +711,95 @@ class JsonRPCClientThread(Thread):
             self._RunEventLoop()
         except:
             log.exception('fatal error, io thread')
+            with self._lock:
+                pending = self._pending
+                self._pending = set()
+            for connection in set(self._connections.values()) | pending:
+                connection.onWentWrong()
+                connection.close()
         self.shutdown()
 
-    def _RunEventLoop(self):
-        long_idle = 0
-        while not self._is_stop:
-            rlist, _ = self._poller.poll(IDLE_INTERVAL_MS * long_idle)
-
-            if rlist:
-                buffer_len = EstimateUnreadBytes(self._output_fd)
-                # ticky to detect clangd's failure
-                if buffer_len == 0:
-                    self._OnWentWrong()
-                    break
-
-            if rlist or len(self._readbuf):
-                long_idle = 0
-
-                if rlist:
-                    buffer_len = EstimateUnreadBytes(self._output_fd)
-                    self._FetchRecvBuffer(buffer_len)
-
-                try:
-                    rr = self._RecvMsg()
-                except OSError as e:
-                    self._OnWentWrong()
-                    break
-
-                if rr:
-                    self._read_queue.put(rr)
+    def shutdown(self):
+        log.warn('io thread shutdown')
+        self._poller.shutdown()
 
-            while True:
-                try:
-                    r = self._write_queue.get_nowait()
-                except queue.Empty:
-                    break
-                # receive shutdown sentinel
-                if r == None:
-                    self._is_stop = True
-                    break
-                try:
-                    self._SendMsg(r)
-                    long_idle = 0
-                except OSError as e:
-                    self._OnWentWrong()
-                    break
-            self._FlushSendBuffer()
+    def _Attach(self, connection):
+        fd = connection.readFd()
+        self._connections[fd] = connection
+        self._poller.register(fd, POLLIN)
+
+    def _Detach(self, connection):
+        for fd in (connection.readFd(), connection.writeFd()):
+            if self._connections.get(fd) is connection:
+                self._connections.pop(fd)
+                self._poller.unregister(fd)
+        connection.close()
+
+    def _UpdateInterest(self, connection):
+        if connection.isStopped():
+            self._Detach(connection)
+            return
+        fd = connection.writeFd()
+        if connection.wantsWrite():
+            if not self._poller.isRegistered(fd):
+                self._connections[fd] = connection
+                self._poller.register(fd, POLLOUT)
+        elif self._poller.isRegistered(fd):
+            self._connections.pop(fd)
+            self._poller.unregister(fd)
 
-            if long_idle < MAX_IDLE_TIMES:
-                long_idle += 1
+    def _RunEventLoop(self):
+        while True:
+            events = self._poller.poll(None)
+            with self._lock:
+                pending = self._pending
+                self._pending = set()
+            touched = set()
+            for fd, event in events:
+                connection = self._connections.get(fd)
+                if not connection:
+                    continue
+                if event & POLLIN:
+                    connection.onReadable()
+                if event & POLLOUT:
+                    connection.onWritable()
+                touched.add(connection)
+            for connection in pending:
+                if connection.isStopped():
+                    connection.close()
+                    continue
+                if not connection.readFd() in self._connections:
+                    self._Attach(connection)
+                connection.onWritable()
+                touched.add(connection)
+            for connection in touched:
+                self._UpdateInterest(connection)
+
+_reactor = None
+_reactor_lock = Lock()
+
+def GetReactor():
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None or not _reactor.is_alive():
+            _reactor = JsonRPCReactor()
+            _reactor.start()
+        return _reactor
 
 class JsonRPCClient(object):
-    def __init__(self, request_observer, input_fd, output_fd):
+    def __init__(self, request_observer, input_fd, output_fd,
+                 pending_ttl_ms=DEFAULT_PENDING_TTL_MS):
         self._no = 0
-        self._requests = {}
+        self._requests = PendingRequestTable(pending_ttl_ms)
+        self._handlers = RequestHandlerRegistry()
         self._observer = request_observer
         self._read_queue = queue.Queue()
-        self._write_queue = queue.Queue()
-        self._io_thread = JsonRPCClientThread(
-            input_fd, output_fd, self._read_queue, self._write_queue)
-        self._io_thread.start()
+        self._write_queue = OutgoingQueue()
+        self._connection = JsonRPCConnection(
+            input_fd, output_fd, self._read_queue, self._write_queue,
+            self._requests, self._handlers)
+        self._reactor = GetReactor()
+        self._reactor.notify(self._connection)
         self._is_stop = False
 
     def stop(self):
@@ -186,42 +807,93 @@ class JsonRPCClient(object):
             return
         # put stop sentinel to io thread
         self._write_queue.put(None)
+        self._reactor.notify(self._connection)
         self._is_stop = True
-        self._io_thread.join()
+        self._connection.waitClosed()
 
-    def sendRequest(self, method, params, nullResponse, timeout_ms):
+    def _NextId(self):
         Id = self._no
         self._no = self._no + 1
-        r = self.SendMsg(method, params, Id=Id)
+        return Id
+
+    def sendRequest(self, method, params, nullResponse, timeout_ms,
+                    context=None, partial=False, versioned=False):
+        """Waits for the response; with partial, the first items of a large
+        result are returned if the full result misses the deadline. With
+        versioned, a response computed against an older version of the
+        document fails with ContentModified."""
+        Id = self._NextId()
+        # the response of a null-response request is dispatched by handleRecv
+        future = self.SendMsg(method, params, Id=Id, context=context,
+                              abandoned=nullResponse, partial=partial,
+                              versioned=versioned)
         if nullResponse:
             return None
-        log.debug('send request: %s' % r)
+        log.debug('send request: %s' % method)
 
         if timeout_ms is None:
             timeout_ms = DEFAULT_TIMEOUT_MS
-        while timeout_ms >= IDLE_INTERVAL_MS:
-            if self._is_stop:
-                self._observer.onServerDown()
-                raise OSError('client is down')
-
-            try:
-                rr = self._read_queue.get_nowait()
-            except queue.Empty:
-                sleep(IDLE_INTERVAL_MS * 0.001)
-                timeout_ms -= IDLE_INTERVAL_MS
-                continue
-            if rr == None:
-                self._observer.onServerDown()
-                raise OSError('io thread stopped')
-            rr = self.RecvMsg(rr)
-            if 'id' in rr and rr['id'] == Id:
-                if 'error' in rr:
-                    raise OSError('bad error_code %d' % rr['error'])
-                return rr['result']
-        raise TimedOutError('msg timeout')
-        return None
+        if not future.wait(timeout_ms) and future.abandon():
+            partial = future.partialResponse()
+            if partial is None:
+                # a late response is still dispatched by handleRecv, the
+                # request is only cancelled once something supersedes it
+                raise TimedOutError('msg timeout', future)
+            # the full response is dispatched by handleRecv
+            self.OnPartialResponse(future, partial)
+            return partial['result']
+        self._requests.pop(Id)
+        rr = future.response()
+        if rr == None or self._is_stop:
+            self._observer.onServerDown()
+            raise OSError('io thread stopped')
+        if 'error' in rr:
+            raise OSError('bad error_code %s' % rr['error'].get('code'))
+        self.OnResponse(future, rr)
+        return rr['result']
+
+    def sendRequestAsync(self, method, params, callback=None, context=None,
+                         partial=False, versioned=False):
+        """Sends a request without waiting for its response.
+
+        The response is dispatched by handleRecv, which also calls
+        callback(result), with None as result if the request failed."""
+        future = self.SendMsg(
+            method, params, Id=self._NextId(), context=context,
+            callback=callback, abandoned=True, partial=partial,
+            versioned=versioned)
+        log.debug('send async request: %s' % method)
+        return future
+
+    def registerRequestHandler(self, method, handler):
+        self._handlers.register(method, handler)
+
+    def cancelRequest(self, Id):
+        """Asks the server to drop the request, its response is discarded by
+        the io thread."""
+        future = self._requests.get(Id)
+        if not future:
+            return False
+        # mark it first, the io thread checks the mark before resolving
+        self._requests.markCancelled(Id)
+        if future.done():
+            self._requests.unmarkCancelled(Id)
+            return False
+        self._requests.pop(Id)
+        future.setResponse(None)
+        future.finish()
+        log.debug('cancel request %s: %s' % (Id, future.method))
+        self.SendMsg(CancelRequest_NOTIFICATION, {'id': Id})
+        return True
 
     def sendNotification(self, method, params):
+        # requests are tagged with the version they are computed against
+        if method in (DidOpenTextDocument_NOTIFICATION,
+                      DidChangeTextDocument_NOTIFICATION):
+            self._requests.setDocumentVersion(
+                params['textDocument']['uri'], params['textDocument']['version'])
+        elif method == DidCloseTextDocument_NOTIFICATION:
+            self._requests.forgetDocument(params['textDocument']['uri'])
         try:
             r = self.SendMsg(method, params)
         except OSError:
@@ -229,7 +901,23 @@ class JsonRPCClient(object):
             raise
         log.info('send notifications: %s' % method)
 
+    def pendingCounts(self):
+        return self._requests.counts()
+
+    def staleCounts(self):
+        return self._requests.staleCounts()
+
+    def _ExpireRequests(self, force=False):
+        for future in self._requests.expire(force):
+            log.warn('request %s expired: %s' % (future.Id, future.method))
+            # done without a response, like a failed request
+            future.setResponse(None)
+            future.finish()
+            if future.callback:
+                future.callback(None)
+
     def handleRecv(self):
+        self._ExpireRequests()
         while True:
             if self._is_stop:
                 raise OSError('client is down')
@@ -237,42 +925,71 @@ class JsonRPCClient(object):
                 rr = self._read_queue.get_nowait()
             except queue.Empty:
                 break
-            if rr == None:
+            if rr == None or isinstance(rr, Exception):
                 self._observer.onServerDown()
                 raise OSError('io thread stopped')
+            if isinstance(rr, PartialResponse):
+                future = self._requests.get(rr.response['id'])
+                if future and not self._requests.isStale(future):
+                    self.OnPartialResponse(future, rr.response)
+                continue
             self.RecvMsg(rr)
 
-    def SendMsg(self, method, params={}, Id=None):
+    def SendMsg(self, method, params={}, Id=None, context=None, callback=None,
+                abandoned=False, partial=False, versioned=False):
         r = {}
         r['jsonrpc'] = '2.0'
         r['method'] = str(method)
         r['params'] = params
-        if Id is not None:
-            r['id'] = Id
-            self._requests[Id] = r
         if self._is_stop:
             raise OSError('client is down')
+        if Id is not None:
+            r['id'] = Id
+            future = RequestFuture(Id, r['method'], context, callback,
+                                   abandoned, partial)
+            if versioned:
+                self._requests.tagDocumentVersion(future, _DocumentUri(r))
+            self._requests.add(future)
+            if len(self._requests) > MAX_PENDING_REQUESTS:
+                self._ExpireRequests(force=True)
+            self._write_queue.put(r)
+            self._reactor.notify(self._connection)
+            return future
         self._write_queue.put(r)
+        self._reactor.notify(self._connection)
         return r
 
     def RecvMsg(self, rr):
         if not 'id' in rr:
             self.OnNotification(rr)
-        elif not rr['id'] in self._requests:
-            self.OnRequest(rr)
         else:
-            self.OnResponse(self._requests[rr['id']], rr)
-            self._requests.pop(rr['id'])
+            future = self._requests.pop(rr['id'])
+            if not future:
+                log.warn('recv response for unknown request %s' % rr['id'])
+                return rr
+            result = None
+            if 'error' in rr:
+                if rr['error'].get('code') == ContentModified_ERROR:
+                    log.debug('recv stale response from: %s' % future.method)
+                else:
+                    log.warn('recv error response from: %s' % future.method)
+            else:
+                self.OnResponse(future, rr)
+                result = rr['result']
+            if future.callback:
+                future.callback(result)
         return rr
 
     def OnNotification(self, request):
         log.info('recv notification: %s' % request['method'])
         self._observer.onNotification(request['method'], request['params'])
 
-    def OnRequest(self, request):
-        log.info('recv request: %s' % request['method'])
-        self._observer.onRequest(request['method'], request['params'])
+    def OnResponse(self, future, response):
+        log.debug('recv response from: %s' % future.method)
+        self._observer.onResponse(future.method, future.context,
+                                  response['result'])
 
-    def OnResponse(self, request, response):
-        log.debug('recv response from: %s' % request['method'])
-        self._observer.onResponse(request, response['result'])
+    def OnPartialResponse(self, future, response):
+        log.debug('recv partial response from: %s' % future.method)
+        self._observer.onPartialResponse(future.method, future.context,
+                                         response['result'])
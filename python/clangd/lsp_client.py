@@ -5,7 +5,7 @@ import subprocess
 from sys import platform as sys_platform
 from subprocess import check_output, CalledProcessError, Popen
 from clangd import glog as log
-from clangd.jsonrpc import JsonRPCClient, TimedOutError
+from clangd.jsonrpc import JsonRPCClient, TimedOutError, DEFAULT_PENDING_TTL_MS
 
 # platform-specific stuff
 if sys_platform == 'win32':
@@ -21,6 +21,8 @@ Completion_REQUEST = 'textDocument/completion'
 Formatting_REQUEST = 'textDocument/formatting'
 RangeFormatting_REQUEST = 'textDocument/rangeFormatting'
 OnTypeFormatting_REQUEST = 'textDocument/onTypeFormatting'
+Definition_REQUEST = 'textDocument/definition'
+Hover_REQUEST = 'textDocument/hover'
 
 Initialized_NOTIFICATION = 'initialized'
 DidOpenTextDocument_NOTIFICATION = 'textDocument/didOpen'
@@ -30,6 +32,18 @@ DidCloseTextDocument_NOTIFICATION = 'textDocument/didClose'
 
 PublishDiagnostics_NOTIFICATION = 'textDocument/publishDiagnostics'
 
+WorkDoneProgressCreate_REQUEST = 'window/workDoneProgress/create'
+Configuration_REQUEST = 'workspace/configuration'
+RegisterCapability_REQUEST = 'client/registerCapability'
+UnregisterCapability_REQUEST = 'client/unregisterCapability'
+ShowMessage_REQUEST = 'window/showMessageRequest'
+ApplyEdit_REQUEST = 'workspace/applyEdit'
+# their edits are applied to the buffer, so a response computed against an
+# older version of the document is dropped. other results are checked by
+# whoever uses them, completions are filtered further as the user types
+VERSIONED_REQUESTS = (Formatting_REQUEST, RangeFormatting_REQUEST,
+                      OnTypeFormatting_REQUEST)
+
 MAX_CLIENT_ERRORS = 100
 MAX_CLIENT_TIMEOUTS = 5000
 
@@ -81,7 +95,8 @@ def StartProcess(executable_name, clangd_log_path=None):
 
 
 class LSPClient(object):
-    def __init__(self, clangd_executable, clangd_log_path, manager):
+    def __init__(self, clangd_executable, clangd_log_path, manager,
+                 pending_ttl_ms=DEFAULT_PENDING_TTL_MS):
         clangd, fdRead, fdWrite, fdClangd = StartProcess(
             clangd_executable, clangd_log_path)
         log.info('clangd started, pid %d' % clangd.pid)
@@ -89,11 +104,15 @@ class LSPClient(object):
         self._input_fd = fdRead
         self._output_fd = fdWrite
         self._clangd_logfd = fdClangd
-        self._rpcclient = JsonRPCClient(self, fdRead, fdWrite)
+        self._rpcclient = JsonRPCClient(self, fdRead, fdWrite,
+                                        pending_ttl_ms)
+        self._RegisterRequestHandlers()
         self._client_errs = 0
         self._client_timeouts = 0
         self._is_alive = True
         self._manager = manager
+        # (method, uri) -> the latest asynchronous or timed out request
+        self._inflight_requests = {}
 
     def CleanUp(self):
         if self._clangd.poll() == None:
@@ -120,16 +139,34 @@ class LSPClient(object):
             self.onDiagnostics(params['uri'], params['diagnostics'])
         pass
 
-    def onRequest(self, method, params):
+    # server requests are answered from the io thread, don't touch vim here
+    def _RegisterRequestHandlers(self):
+        handlers = {
+            WorkDoneProgressCreate_REQUEST: lambda params: None,
+            Configuration_REQUEST:
+            lambda params: [None] * len(params.get('items', [])),
+            RegisterCapability_REQUEST: lambda params: None,
+            UnregisterCapability_REQUEST: lambda params: None,
+            ShowMessage_REQUEST: lambda params: None,
+            ApplyEdit_REQUEST: lambda params: {'applied': False},
+        }
+        for method, handler in handlers.items():
+            self.registerRequestHandler(method, handler)
+
+    def registerRequestHandler(self, method, handler):
+        self._rpcclient.registerRequestHandler(method, handler)
+
+    def onResponse(self, method, context, response):
+        if method == Completion_REQUEST:
+            uri, line, character = context
+            self.onCodeCompletions(uri, line, character, response)
         pass
 
-    def onResponse(self, request, response):
-        if request['method'] == Completion_REQUEST:
-            params = request['params']
-            self.onCodeCompletions(params['textDocument']['uri'],
-                                   params['position']['line'],
-                                   params['position']['character'], response)
-        pass
+    def onPartialResponse(self, method, context, response):
+        # the leading items of a large result, the full one follows
+        if method == Completion_REQUEST and isinstance(response, list):
+            response = {'isIncomplete': True, 'items': response}
+        self.onResponse(method, context, response)
 
     def onServerDown(self):
         if self._is_alive:
@@ -143,7 +180,14 @@ class LSPClient(object):
             rr = self._SendRequest(Initialize_REQUEST, {
                 'processId': os.getpid(),
                 'rootUri': 'file://' + os.getcwd(),
-                'capabilities': {},
+                'capabilities': {
+                    'textDocument': {
+                        'synchronization': {
+                            'dynamicRegistration': False,
+                            'didSave': True,
+                        },
+                    },
+                },
                 'trace': 'off'
             }, timeout_ms = 5000)
         except TimedOutError as e:
@@ -196,23 +240,69 @@ class LSPClient(object):
                                                                        params))
             raise
 
+    def _SupersedeRequest(self, method, params):
+        """Cancels the request a new one for the same document replaces,
+        returns the key the new one goes under."""
+        if not 'textDocument' in params:
+            return None
+        key = (method, params['textDocument']['uri'])
+        if key in self._inflight_requests:
+            self.cancelRequest(self._inflight_requests.pop(key))
+        return key
+
     def _SendRequest(self,
                      method,
                      params={},
                      nullResponse=False,
-                     timeout_ms=None):
+                     timeout_ms=None,
+                     context=None,
+                     partial=False):
+        key = self._SupersedeRequest(method, params)
         try:
-            return self._rpcclient.sendRequest(method, params, nullResponse,
-                                               timeout_ms)
+            return self._rpcclient.sendRequest(
+                method, params, nullResponse, timeout_ms, context, partial,
+                method in VERSIONED_REQUESTS)
         except OSError as e:
             if isinstance(e, TimedOutError):
                 self._client_timeouts += 1
+                # its late response may still be wanted
+                if key and e.future:
+                    self._inflight_requests[key] = e.future
             else:
                 self._client_errs += 1
                 log.exception("send request %s with params %s" % (method,
                                                                   params))
             raise
 
+    def _SendRequestAsync(self, method, params={}, callback=None,
+                          context=None, partial=False):
+        # a newer request for the same document supersedes the older one
+        key = self._SupersedeRequest(method, params)
+        try:
+            handle = self._rpcclient.sendRequestAsync(
+                method, params, callback, context, partial,
+                method in VERSIONED_REQUESTS)
+            self._inflight_requests[key] = handle
+            return handle
+        except OSError as e:
+            self._client_errs += 1
+            log.exception("send async request %s with params %s" % (method,
+                                                                    params))
+            raise
+
+    def pendingRequestCounts(self):
+        return self._rpcclient.pendingCounts()
+
+    def staleResponseCounts(self):
+        return self._rpcclient.staleCounts()
+
+    def cancelRequest(self, handle):
+        try:
+            return self._rpcclient.cancelRequest(handle.requestId())
+        except OSError:
+            log.exception('failed to cancel request %s' % handle.requestId())
+            return False
+
     # notifications
     def didOpenTestDocument(self, uri, text, file_type):
         return self._SendNotification(DidOpenTextDocument_NOTIFICATION, {
@@ -235,6 +325,15 @@ class LSPClient(object):
             }]
         })
 
+    def didChangeTestDocumentIncrementally(self, uri, version, changes):
+        return self._SendNotification(DidChangeTextDocument_NOTIFICATION, {
+            'textDocument': {
+                'uri': uri,
+                'version': version
+            },
+            'contentChanges': changes
+        })
+
     def didCloseTestDocument(self, uri):
         return self._SendNotification(DidCloseTextDocument_NOTIFICATION,
                                       {'textDocument': {
@@ -253,28 +352,26 @@ class LSPClient(object):
     def onCodeCompletions(self, uri, line, column, completions):
         self._manager.onCodeCompletions(uri, line, column, completions)
 
-    def codeCompleteAt(self, uri, line, character, timeout_ms):
-        return self._SendRequest(
-            Completion_REQUEST, {
-                'textDocument': {
-                    'uri': uri,
-                },
-                'position': {
-                    'line': line,
-                    'character': character
-                }
+    def _TextDocumentPositionParams(self, uri, line, character):
+        return {
+            'textDocument': {
+                'uri': uri,
             },
-            timeout_ms=timeout_ms)
+            'position': {
+                'line': line,
+                'character': character
+            }
+        }
 
-    def format(self, uri):
-        return self._SendRequest(Formatting_REQUEST,
-                                 {'textDocument': {
-                                     'uri': uri,
-                                 }})
+    def _CompletionParams(self, uri, line, character):
+        return self._TextDocumentPositionParams(uri, line, character)
 
-    def rangeFormat(self, uri, start_line, start_character, end_line,
-                    end_character):
-        return self._SendRequest(RangeFormatting_REQUEST, {
+    def _FormattingParams(self, uri):
+        return {'textDocument': {'uri': uri}}
+
+    def _RangeFormattingParams(self, uri, start_line, start_character,
+                               end_line, end_character):
+        return {
             'textDocument': {
                 'uri': uri,
             },
@@ -288,11 +385,11 @@ class LSPClient(object):
                     'character': end_character,
                 },
             }
-        })
+        }
 
-    def onTypeFormat(self, uri, line, character, ch=None):
+    def _OnTypeFormattingParams(self, uri, line, character):
         # clangd don't use ch yet
-        return self._SendRequest(OnTypeFormatting_REQUEST, {
+        return {
             'textDocument': {
                 'uri': uri,
             },
@@ -300,4 +397,73 @@ class LSPClient(object):
                 'line': line,
                 'character': character
             }
-        })
+        }
+
+    def codeCompleteAt(self, uri, line, character, timeout_ms):
+        return self._SendRequest(
+            Completion_REQUEST,
+            self._CompletionParams(uri, line, character),
+            timeout_ms=timeout_ms,
+            context=(uri, line, character),
+            partial=True)
+
+    def definition(self, uri, line, character):
+        return self._SendRequest(Definition_REQUEST,
+                                 self._TextDocumentPositionParams(
+                                     uri, line, character))
+
+    def hover(self, uri, line, character):
+        return self._SendRequest(Hover_REQUEST,
+                                 self._TextDocumentPositionParams(
+                                     uri, line, character))
+
+    def format(self, uri):
+        return self._SendRequest(Formatting_REQUEST,
+                                 self._FormattingParams(uri))
+
+    def rangeFormat(self, uri, start_line, start_character, end_line,
+                    end_character):
+        return self._SendRequest(RangeFormatting_REQUEST,
+                                 self._RangeFormattingParams(
+                                     uri, start_line, start_character,
+                                     end_line, end_character))
+
+    def onTypeFormat(self, uri, line, character, ch=None):
+        return self._SendRequest(OnTypeFormatting_REQUEST,
+                                 self._OnTypeFormattingParams(
+                                     uri, line, character))
+
+    # asynchronous requests return a handle immediately, results are delivered
+    # from handleClientRequests, completions through onCodeCompletions
+    def codeCompleteAtAsync(self, uri, line, character, callback=None):
+        return self._SendRequestAsync(
+            Completion_REQUEST,
+            self._CompletionParams(uri, line, character), callback,
+            context=(uri, line, character),
+            partial=True)
+
+    def definitionAsync(self, uri, line, character, callback=None):
+        return self._SendRequestAsync(Definition_REQUEST,
+                                      self._TextDocumentPositionParams(
+                                          uri, line, character), callback)
+
+    def hoverAsync(self, uri, line, character, callback=None):
+        return self._SendRequestAsync(Hover_REQUEST,
+                                      self._TextDocumentPositionParams(
+                                          uri, line, character), callback)
+
+    def formatAsync(self, uri, callback=None):
+        return self._SendRequestAsync(Formatting_REQUEST,
+                                      self._FormattingParams(uri), callback)
+
+    def rangeFormatAsync(self, uri, start_line, start_character, end_line,
+                         end_character, callback=None):
+        return self._SendRequestAsync(RangeFormatting_REQUEST,
+                                      self._RangeFormattingParams(
+                                          uri, start_line, start_character,
+                                          end_line, end_character), callback)
+
+    def onTypeFormatAsync(self, uri, line, character, ch=None, callback=None):
+        return self._SendRequestAsync(OnTypeFormatting_REQUEST,
+                                      self._OnTypeFormattingParams(
+                                          uri, line, character), callback)
@@ -0,0 +1,137 @@
+# prefix lookups over completion items
+#
+# the words are kept in one sorted list, a lookup bisects to both ends of
+# the words starting with the prefix.
+import sys
+from bisect import bisect_left
+from heapq import merge, nsmallest
+from itertools import islice
+from clangd_support.python_utils import PY2
+
+_Chr = unichr if PY2 else chr
+
+
+def _ToText(word):
+    if PY2 and isinstance(word, str):
+        return word.decode('utf-8')
+    return word
+
+
+def PrefixEnd(prefix):
+    """Returns the smallest text above every word starting with prefix, None
+    if nothing is."""
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            return prefix[:-1] + _Chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+class PrefixIndex(object):
+    def __init__(self):
+        self._words = []
+        self._data = []
+        # built on demand, first character -> (data, word) of the words
+        # starting with it in data order, '' -> all data in order
+        self._ranked = None
+        # (word, sequence, data) added since the last lookup
+        self._pending = []
+
+    def __len__(self):
+        return len(self._words) + len(self._pending)
+
+    def insert(self, word, data=None):
+        self._pending.append((_ToText(word), len(self), data))
+
+    def _Build(self):
+        if not self._pending:
+            return
+        entries = list(zip(self._words, range(len(self._words)), self._data))
+        entries.extend(self._pending)
+        # equal words keep their insertion order
+        entries.sort(key=lambda entry: entry[0:2])
+        self._words = [entry[0] for entry in entries]
+        self._data = [entry[2] for entry in entries]
+        self._ranked = None
+        self._pending = []
+
+    def search(self, word):
+        word = _ToText(word)
+        self._Build()
+        index = bisect_left(self._words, word)
+        return index < len(self._words) and self._words[index] == word
+
+    def _PrefixRange(self, prefix):
+        """Returns [lo, hi) of the words starting with prefix."""
+        self._Build()
+        words = self._words
+        if not prefix:
+            return 0, len(words)
+        lo = bisect_left(words, prefix)
+        end = PrefixEnd(prefix)
+        if end is None:
+            return lo, len(words)
+        return lo, bisect_left(words, end, lo)
+
+    def iterPrefix(self, prefix):
+        """Yields (word, data) in word order for words starting with
+        prefix."""
+        lo, hi = self._PrefixRange(_ToText(prefix))
+        for index in range(lo, hi):
+            yield self._words[index], self._data[index]
+
+    def searchPrefix(self, prefix):
+        return [data for _, data in self.iterPrefix(prefix)]
+
+    def _Ranked(self):
+        if self._ranked is None:
+            self._ranked = {'': sorted(self._data)}
+            words = self._words
+            lo = 0
+            while lo < len(words):
+                first = words[lo][:1]
+                if not first:
+                    # only the empty prefix matches an empty word
+                    lo += 1
+                    continue
+                end = PrefixEnd(first)
+                hi = bisect_left(words, end, lo) if end else len(words)
+                self._ranked[first] = sorted(
+                    zip(islice(self._data, lo, hi), islice(words, lo, hi)))
+                lo = hi
+        return self._ranked
+
+    def topPrefix(self, prefix, limit):
+        """Returns up to limit data of words starting with prefix, smallest
+        data first. data must be comparable.
+
+        Words are ranked in advance per first character, so the empty and
+        one-letter prefixes take a slice. A longer prefix walks its bucket in
+        rank order while it matches most of it, and selects among the words
+        it matches otherwise."""
+        prefix = _ToText(prefix)
+        self._Build()
+        ranked = self._Ranked()
+        if not prefix:
+            return ranked[''][:limit]
+        bucket = ranked.get(prefix[0], [])
+        if len(prefix) == 1:
+            return [data for data, _ in bucket[:limit]]
+        lo, hi = self._PrefixRange(prefix)
+        # a walk sees about limit * len(bucket) / matches words
+        if (hi - lo) * (hi - lo) > limit * len(bucket):
+            return list(islice((data for data, word in bucket
+                                if word.startswith(prefix)), limit))
+        return nsmallest(limit, islice(self._data, lo, hi))
+
+
+def TopPrefixMatches(indexes, prefix, limit):
+    """Returns up to limit data across indexes for words starting with
+    prefix. data are (rank, value) pairs ordered by rank then value, so
+    values must be comparable where ranks tie.
+
+    Each index gives its limit best matches, so the best ones overall are
+    among them."""
+    streams = [index.topPrefix(prefix, limit) for index in indexes]
+    return list(islice(merge(*streams), limit))
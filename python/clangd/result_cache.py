@@ -0,0 +1,73 @@
+# results of position based queries
+#
+# keys start with (uri, version), so an edited document never hits old
+# results; its entries are dropped as soon as the version moves on.
+from collections import OrderedDict
+from clangd_support.python_utils import monotonic
+
+DEFAULT_MAX_SIZE = 64
+DEFAULT_MAX_AGE_MS = 30000
+
+
+class ResultCache(object):
+    """LRU cache of (uri, version, method, position) -> result.
+
+    Entries older than max_age_ms are not returned, and the least recently
+    used ones are evicted beyond max_size entries."""
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 max_age_ms=DEFAULT_MAX_AGE_MS):
+        self._max_size = max_size
+        self._max_age = max_age_ms * 0.001
+        # key -> (time stored, result), least recently used first
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+        self._expired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # unlike get, doesn't count or touch the entry
+        entry = self._entries.get(key)
+        return entry is not None and monotonic() - entry[0] <= self._max_age
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self._misses += 1
+            return default
+        if monotonic() - entry[0] > self._max_age:
+            self._expired += 1
+            self._misses += 1
+            return default
+        # most recently used goes last
+        self._entries[key] = entry
+        self._hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        self._entries.pop(key, None)
+        self._entries[key] = (monotonic(), result)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evicted += 1
+
+    def invalidate(self, uri, version=None):
+        """Drops the entries of uri, except those of version."""
+        for key in list(self._entries.keys()):
+            if key[0] == uri and key[1] != version:
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def counts(self):
+        return {
+            'size': len(self._entries),
+            'hits': self._hits,
+            'misses': self._misses,
+            'evicted': self._evicted,
+            'expired': self._expired,
+        }
@@ -0,0 +1,96 @@
+# incremental decoding of large jsonrpc responses
+#
+# a completion response for something like `std::` carries thousands of items,
+# decoding it in one go holds the GIL until the last item is done. here the
+# envelope is walked with raw_decode so the result items come out one by one.
+import json
+import re
+
+FIELD = 0
+RESULT = 1
+RESULT_FIELD = 2
+RESULT_ITEMS = 3
+RESULT_ITEM = 4
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class StreamingResponseDecoder(object):
+    """Walks a response and yields (kind, key, value) events.
+
+    FIELD is a top-level member. RESULT is emitted with value 'list' or
+    'object' before a structured result is decoded, so the caller can stop
+    early. RESULT_FIELD is a member of a result object, RESULT_ITEMS starts
+    the result's 'items' member and RESULT_ITEM is an element of either the
+    result list or the 'items' member."""
+    def __init__(self, body):
+        self._body = body
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _Skip(self):
+        self._pos = WHITESPACE.match(self._body, self._pos).end()
+
+    def _Peek(self):
+        self._Skip()
+        if self._pos >= len(self._body):
+            raise ValueError('unexpected end of json')
+        return self._body[self._pos]
+
+    def _Expect(self, c):
+        if self._Peek() != c:
+            raise ValueError('expecting %s at %d' % (c, self._pos))
+        self._pos += 1
+
+    def _Value(self):
+        self._Skip()
+        value, self._pos = self._decoder.raw_decode(self._body, self._pos)
+        return value
+
+    def _Members(self):
+        # the caller consumes each member's value before resuming
+        self._Expect('{')
+        if self._Peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._Value()
+            self._Expect(':')
+            yield key
+            if self._Peek() == '}':
+                self._pos += 1
+                return
+            self._Expect(',')
+
+    def _Elements(self):
+        self._Expect('[')
+        if self._Peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._Value()
+            if self._Peek() == ']':
+                self._pos += 1
+                return
+            self._Expect(',')
+
+    def events(self):
+        for key in self._Members():
+            if key != 'result' or not self._Peek() in '[{':
+                yield FIELD, key, self._Value()
+            elif self._Peek() == '[':
+                yield RESULT, key, 'list'
+                for item in self._Elements():
+                    yield RESULT_ITEM, None, item
+            else:
+                yield RESULT, key, 'object'
+                for result_key in self._Members():
+                    if result_key == 'items' and self._Peek() == '[':
+                        yield RESULT_ITEMS, result_key, None
+                        for item in self._Elements():
+                            yield RESULT_ITEM, None, item
+                    else:
+                        yield RESULT_FIELD, result_key, self._Value()
+        self._Skip()
+        if self._pos != len(self._body):
+            raise ValueError('extra data at %d' % self._pos)
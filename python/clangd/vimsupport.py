@@ -1,4 +1,5 @@
 import os
+import json
 import vim
 from clangd import glog as log
 from clangd_support.python_utils import PY_VERSION, PY2
@@ -28,6 +29,10 @@ def CurrentLine():
     return vim.current.line
 
 
+def CurrentMode():
+    return vim.eval('mode()')
+
+
 def CurrentBuffer():
     return vim.current.buffer
 
@@ -48,6 +53,25 @@ def GetBufferByName(file_name):
             return buf
     return None
 
+def GetBufferByNumber(buffer_number):
+    for buf in vim.buffers:
+        if buf.number == buffer_number:
+            return buf
+    return None
+
+def ExtractUTF8Lines(buf, start=0, end=None):
+    """Returns buffer lines [start, end) as utf-8 text."""
+    if end is None:
+        end = len(buf)
+    lines = buf[start:end]
+    if not PY2:
+        return lines
+
+    enc = buf.options['fileencoding']
+    if enc:
+        return [line.decode(enc).encode('utf-8') for line in lines]
+    return lines
+
 def ExtractUTF8Text(buf):
     if not PY2:
         return '\n'.join(buf)
@@ -96,39 +120,105 @@ def GetBufferNumberForFilename(filename, open_file_if_needed=True):
         EscapeForVim(os.path.realpath(filename)), int(open_file_if_needed)))
 
 
-# clean all signs for existing buffer
-# FIXME clean clangdSigns only
-def UnplaceAllSigns():
-    buffer_num = vim.current.buffer.number
-    vim.command('sign unplace * buffer=%d' % buffer_num)
+def HasBufferListener():
+    return GetBoolValue("exists('*listener_add')")
 
 
-def PlaceSignForErrorMessage(buffer_num, index, diagnostic):
-    if diagnostic['severity'] >= 3:
-        sign_name = 'clangdError'
-    else:
-        sign_name = 'clangdWarning'
+def AddBufferListener(buffer_number):
+    """Returns the listener id, or 0 if vim can't report buffer changes."""
+    if not HasBufferListener():
+        return 0
+    return GetIntValue(
+        "listener_add('clangd#OnBufferLinesChanged', %d)" % buffer_number)
+
+
+def RemoveBufferListener(listener_id):
+    vim.eval('listener_remove(%d)' % listener_id)
+
+
+def FlushBufferListener(buffer_number):
+    # callbacks are deferred until the next redraw otherwise
+    vim.eval('listener_flush(%d)' % buffer_number)
+
+
+def StartTimer(delay_ms, callback, repeat=False):
+    """Starts a vim timer, returns its id."""
+    if repeat:
+        return GetIntValue("timer_start(%d, '%s', {'repeat': -1})" %
+                           (delay_ms, callback))
+    return GetIntValue("timer_start(%d, '%s')" % (delay_ms, callback))
+
+
+def StopTimer(timer_id):
+    vim.eval('timer_stop(%d)' % timer_id)
 
+
+def HasSignGroups():
+    return GetBoolValue("exists('*sign_place')")
+
+
+def HasTextProperties():
+    # sign_placelist() came after text properties, both are needed to render
+    # a buffer in one call
+    return GetBoolValue("has('textprop') && exists('*sign_placelist')")
+
+
+def RenderDiagnostics(buffer_num, group, clear_types, removed_props,
+                      added_props, removed_signs, added_signs):
+    """Applies a diagnostics update to a buffer in a single vim call, see
+    clangd#RenderDiagnostics."""
+    # lists of numbers and plain names read the same in json and vim
+    args = ', '.join(
+        json.dumps(arg)
+        for arg in (group, clear_types, removed_props, added_props,
+                    removed_signs, added_signs))
+    expr = 'clangd#RenderDiagnostics(%d, %s)' % (buffer_num, args)
+    try:
+        vim.eval(expr)
+    except:
+        log.exception('failed to render diagnostics in buffer %d' %
+                      buffer_num)
+
+
+def CurrentWindowId():
+    return GetIntValue('win_getid()')
+
+
+def _SignGroupArg(group):
+    return ' group=%s' % group if group else ''
+
+
+def PlaceSign(sign_id, line_num, sign_name, buffer_num, group=None):
+    command = 'sign place %d%s line=%d name=%s buffer=%d' % (
+        sign_id, _SignGroupArg(group), line_num, sign_name, buffer_num)
     try:
-        vim.command('sign place %d line=%d name=%s buffer=%d' %
-                    (index, diagnostic['lnum'], sign_name, buffer_num))
+        vim.command(command)
     except:
-        log.exception('sign place %d line=%d name=%s buffer=%d' %
-                    (index, diagnostic['lnum'], sign_name, buffer_num))
+        log.exception(command)
 
 
-def PlaceSignForErrorMessageArray(diagnostics):
-    buffer_num = vim.current.buffer.number
+def UnplaceSign(sign_id, buffer_num, group=None):
+    command = 'sign unplace %d%s buffer=%d' % (sign_id, _SignGroupArg(group),
+                                               buffer_num)
+    try:
+        vim.command(command)
+    except:
+        log.exception(command)
+
 
-    index = 1
-    for line_num in diagnostics:
-        # FIXME we should show most severity error
-        PlaceSignForErrorMessage(buffer_num, index, diagnostics[line_num][0])
-        index += 1
+def UnplaceSignGroup(buffer_num, group):
+    command = 'sign unplace * group=%s buffer=%d' % (group, buffer_num)
+    try:
+        vim.command(command)
+    except:
+        log.exception(command)
 
 
 def ConvertDiagnosticsToQfList(file_name, diagnostics):
     retval = []
+    if not diagnostics:
+        return retval
+    buffer_num = GetBufferNumberForFilename(file_name)
     for diagnostic in diagnostics:
         location = diagnostic['range']['start']
         line = location['line'] + 1
@@ -141,7 +231,7 @@ def ConvertDiagnosticsToQfList(file_name, diagnostics):
             continue
 
         retval.append({
-            'bufnr': GetBufferNumberForFilename(file_name),
+            'bufnr': buffer_num,
             'lnum': line,
             'col': column,
             'text': ToUtf8IfNeeded(msg),
@@ -198,6 +288,11 @@ def ClearClangdSyntaxMatches():
             vim.eval('matchdelete({0})'.format(match['id']))
 
 
+def DeleteSyntaxMatch(match_id):
+    # the match is gone already if the user cleared them
+    vim.command('silent! call matchdelete(%d)' % match_id)
+
+
 def AddDiagnosticSyntaxMatch(line_num,
                              column_num,
                              line_end_num=None,
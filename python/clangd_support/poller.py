@@ -1,42 +1,208 @@
 """ poller for cross-platform """
 
-from select import select
+import os
+from select import select, error as select_error
+from errno import EINTR, EAGAIN
 from clangd_support.python_utils import PY2
 
+try:
+    import selectors
+except ImportError:
+    # python2 falls back to plain select
+    selectors = None
+
+POLLIN = 1
+POLLOUT = 2
+
+
 class Poller(object):
-    def __init__(self, rfds, wfds):
-        self._rfds = rfds
-        self._wfds = wfds
+    def __init__(self):
+        # fd -> interested events
+        self._fds = {}
+
+    def register(self, fd, events):
+        self._fds[fd] = events
+
+    def modify(self, fd, events):
+        self._fds[fd] = events
+
+    def unregister(self, fd):
+        self._fds.pop(fd, None)
+
+    def isRegistered(self, fd):
+        return fd in self._fds
+
+    def wakeup(self):
+        raise NotImplementedError('not okay')
 
     def shutdown(self):
         pass
 
     def poll(self, timeout_ms):
+        """Returns a list of (fd, events), waits forever if timeout_ms is None."""
         raise NotImplementedError('not okay')
 
 
+def _SelectTimeout(timeout_ms):
+    if timeout_ms is None:
+        return None
+    return timeout_ms * 0.001
+
+
 class Win32Poller(Poller):
-    def __init__(self, rfds, wfds):
+    def __init__(self):
         if PY2:
-            super(Win32Poller, self).__init__(rfds, wfds)
+            super(Win32Poller, self).__init__()
         else:
-            super().__init__(rfds, wfds)
-        self._rhandles = [ rfd.filehandle() for rfd in rfds ]
-        self._whandles = [ rfd.filehandle() for wfd in wfds ]
+            super().__init__()
+        from clangd_support.win32_utils import Win32SocketPair, SetNonBlock
+        self._wake_r, self._wake_w = Win32SocketPair()
+        SetNonBlock(self._wake_r)
+        SetNonBlock(self._wake_w)
+
+    def wakeup(self):
+        try:
+            os.write(self._wake_w.fileno(), b'\0')
+        except OSError as e:
+            if e.errno != EAGAIN and e.errno != EINTR:
+                raise
+
+    def _DrainWakeup(self):
+        try:
+            while os.read(self._wake_r.fileno(), 512):
+                pass
+        except OSError as e:
+            if e.errno != EAGAIN and e.errno != EINTR:
+                raise
+
+    def shutdown(self):
+        self._wake_r.close()
+        self._wake_w.close()
 
     def poll(self, timeout_ms):
-        rs, ws, _ = select(self._rhandles, self._whandles, [], timeout_ms * 0.001)
-        # FIXME convert to fd
-        return rs, ws
+        handles = {self._wake_r.filehandle(): self._wake_r}
+        rhandles = [self._wake_r.filehandle()]
+        whandles = []
+        for fd, events in self._fds.items():
+            handles[fd.filehandle()] = fd
+            if events & POLLIN:
+                rhandles.append(fd.filehandle())
+            if events & POLLOUT:
+                whandles.append(fd.filehandle())
+        rs, ws, _ = select(rhandles, whandles, [], _SelectTimeout(timeout_ms))
+        ready = {}
+        for handle in rs:
+            ready[handles[handle]] = POLLIN
+        for handle in ws:
+            ready[handles[handle]] = ready.get(handles[handle], 0) | POLLOUT
+        if ready.pop(self._wake_r, None):
+            self._DrainWakeup()
+        return list(ready.items())
+
 
 class PosixPoller(Poller):
-    def __init__(self, rfds, wfds):
+    """Poller backed by epoll/kqueue where available, woken by a self-pipe."""
+    def __init__(self):
         if PY2:
-            super(PosixPoller, self).__init__(rfds, wfds)
+            super(PosixPoller, self).__init__()
         else:
-            super().__init__(rfds, wfds)
+            super().__init__()
+        from clangd_support.posix_utils import SetNonBlock, SetCloseOnExec
+        self._wake_rfd, self._wake_wfd = os.pipe()
+        for fd in (self._wake_rfd, self._wake_wfd):
+            SetNonBlock(fd)
+            SetCloseOnExec(fd)
+        self._selector = None
+        if selectors:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._wake_rfd, selectors.EVENT_READ)
 
-    def poll(self, timeout_ms):
-        rfds, wfds, _ = select(self._rfds, self._wfds, [], timeout_ms * 0.001)
-        return rfds, wfds
+    def _ToSelectorEvents(self, events):
+        mask = 0
+        if events & POLLIN:
+            mask |= selectors.EVENT_READ
+        if events & POLLOUT:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def register(self, fd, events):
+        Poller.register(self, fd, events)
+        if self._selector:
+            self._selector.register(fd, self._ToSelectorEvents(events))
+
+    def modify(self, fd, events):
+        Poller.modify(self, fd, events)
+        if self._selector:
+            self._selector.modify(fd, self._ToSelectorEvents(events))
+
+    def unregister(self, fd):
+        if self._selector and fd in self._fds:
+            self._selector.unregister(fd)
+        Poller.unregister(self, fd)
+
+    def wakeup(self):
+        try:
+            os.write(self._wake_wfd, b'\0')
+        except OSError as e:
+            # a full pipe has wakeups pending already
+            if e.errno != EAGAIN and e.errno != EINTR:
+                raise
 
+    def _DrainWakeup(self):
+        try:
+            while os.read(self._wake_rfd, 512):
+                pass
+        except OSError as e:
+            if e.errno != EAGAIN and e.errno != EINTR:
+                raise
+
+    def shutdown(self):
+        if self._selector:
+            self._selector.close()
+        os.close(self._wake_rfd)
+        os.close(self._wake_wfd)
+
+    def _PollSelector(self, timeout_ms):
+        ready = []
+        for key, mask in self._selector.select(_SelectTimeout(timeout_ms)):
+            events = 0
+            if mask & selectors.EVENT_READ:
+                events |= POLLIN
+            if mask & selectors.EVENT_WRITE:
+                events |= POLLOUT
+            ready.append((key.fd, events))
+        return ready
+
+    def _PollSelect(self, timeout_ms):
+        rfds = [self._wake_rfd]
+        wfds = []
+        for fd, events in self._fds.items():
+            if events & POLLIN:
+                rfds.append(fd)
+            if events & POLLOUT:
+                wfds.append(fd)
+        try:
+            rs, ws, _ = select(rfds, wfds, [], _SelectTimeout(timeout_ms))
+        except select_error as e:
+            if e.args[0] != EINTR:
+                raise
+            return []
+        ready = {}
+        for fd in rs:
+            ready[fd] = POLLIN
+        for fd in ws:
+            ready[fd] = ready.get(fd, 0) | POLLOUT
+        return list(ready.items())
+
+    def poll(self, timeout_ms):
+        if self._selector:
+            ready = self._PollSelector(timeout_ms)
+        else:
+            ready = self._PollSelect(timeout_ms)
+        events = []
+        for fd, event in ready:
+            if fd == self._wake_rfd:
+                self._DrainWakeup()
+            else:
+                events.append((fd, event))
+        return events
@@ -19,6 +19,19 @@ except ImportError:
         raise
 from os import pipe, read, write
 
+try:
+    from os import writev
+except ImportError:
+    # python2
+    writev = None
+
+# fcntl.F_SETPIPE_SZ is only exported since python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ',
+                       1031 if sys_platform.startswith('linux') else None)
+PIPE_BUFFER_SIZES = [1024 * 1024, 256 * 1024]
+# keep below the smallest IOV_MAX in the wild
+MAX_IOV_COUNT = 64
+
 
 def EstimateUnreadBytes(fd):
     buf = array('i', [0])
@@ -38,8 +51,22 @@ def SetNonBlock(fd):
     fcntl.fcntl(fd, fcntl.F_SETFL, flags)
 
 
+def EnlargePipeBuffer(fd):
+    if F_SETPIPE_SZ is None:
+        return 0
+    for size in PIPE_BUFFER_SIZES:
+        try:
+            return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        except (IOError, OSError):
+            # exceeds /proc/sys/fs/pipe-max-size
+            continue
+    return 0
+
+
 def Pipe():
-    return pipe()
+    fdRead, fdWrite = pipe()
+    EnlargePipeBuffer(fdWrite)
+    return fdRead, fdWrite
 
 
 def WriteUtf8(fd, data):
@@ -60,7 +87,26 @@ def WriteUtf8(fd, data):
     return written
 
 
-def ReadUtf8(fd, length):
+def WriteVectored(fd, buffers):
+    """Writes as much of the buffers as possible without blocking and returns
+    the number of bytes written."""
+    while True:
+        try:
+            if writev:
+                ret = writev(fd, buffers[:MAX_IOV_COUNT])
+            else:
+                ret = write(fd, buffers[0])
+            if ret == 0:
+                raise OSError('broken pipe')
+            return ret
+        except OSError as e:
+            if e.errno == EAGAIN:
+                return 0
+            if e.errno != EINTR:
+                raise
+
+
+def ReadBytes(fd, length):
     msg = bytes()
     while length:
         try:
@@ -74,4 +120,8 @@ def ReadUtf8(fd, length):
                 break
             if e.errno != EINTR:
                 raise
-    return msg.decode('utf-8')
+    return msg
+
+
+def ReadUtf8(fd, length):
+    return ReadBytes(fd, length).decode('utf-8')
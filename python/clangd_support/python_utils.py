@@ -5,3 +5,9 @@ PY2 = PY_VERSION  == 2
 def PyVersion():
     return PY_VERSION
 
+
+try:
+    from time import monotonic
+except ImportError:
+    # python2
+    from time import time as monotonic
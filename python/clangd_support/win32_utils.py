@@ -351,7 +351,22 @@ def WriteUtf8(winsocket, data):
     return written
 
 
-def ReadUtf8(winsocket, length):
+def WriteVectored(winsocket, buffers):
+    fd = winsocket.fileno()
+    while True:
+        try:
+            ret = os.write(fd, buffers[0])
+            if ret == 0:
+                raise OSError('broken pipe')
+            return ret
+        except OSError as e:
+            if e.errno == EAGAIN:
+                return 0
+            if e.errno != EINTR:
+                raise
+
+
+def ReadBytes(winsocket, length):
     msg = bytes()
     fd = winsocket.fileno()
     while length:
@@ -366,4 +381,8 @@ def ReadUtf8(winsocket, length):
                 break
             if e.errno != EINTR:
                 raise
-    return msg.decode('utf-8')
+    return msg
+
+
+def ReadUtf8(winsocket, length):
+    return ReadBytes(winsocket, length).decode('utf-8')
@@ -0,0 +1,71 @@
+"""Request throughput of pipelined sendRequestAsync against one blocking
+sendRequest at a time. The fake server answers each completion after a
+fixed latency, several at once like clangd's worker threads.
+
+    python python/tests/bench_async.py [requests] [latency ms]
+"""
+import logging
+import sys
+import time
+from threading import Lock, Timer
+
+# puts the plugin on sys.path as well
+from test_jsonrpc import FakeServer, Observer, Completion_REQUEST
+
+from clangd.jsonrpc import JsonRPCClient
+
+
+class LatentServer(object):
+    def __init__(self, latency_ms):
+        self._latency = latency_ms * 0.001
+        self._lock = Lock()
+
+    def _Answer(self, server, message):
+        result = {'isIncomplete': False, 'items': [
+            {'label': 'item%d' % i, 'kind': 3} for i in range(20)]}
+        with self._lock:
+            server.send({'jsonrpc': '2.0', 'id': message['id'],
+                         'result': result})
+
+    def onMessage(self, server, message):
+        if message.get('method') == Completion_REQUEST:
+            Timer(self._latency, self._Answer, (server, message)).start()
+
+
+def _Sequential(client, count):
+    for i in range(count):
+        client.sendRequest(Completion_REQUEST, {}, False, 5000)
+
+
+def _Pipelined(client, count):
+    results = []
+    for i in range(count):
+        client.sendRequestAsync(Completion_REQUEST, {}, results.append)
+    while len(results) < count:
+        client.handleRecv()
+        time.sleep(0.001)
+    assert not None in results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    logging.disable(logging.WARNING)
+    server = FakeServer(LatentServer(latency_ms).onMessage)
+    server.start()
+    client = JsonRPCClient(Observer(), server.client_input,
+                           server.client_output)
+    try:
+        for name, run in (('sequential', _Sequential),
+                          ('pipelined', _Pipelined)):
+            start = time.time()
+            run(client, count)
+            elapsed = time.time() - start
+            print('%-10s %d requests, %.0fms latency: %7.1fms, %6.0f/s' %
+                  (name, count, latency_ms, elapsed * 1000, count / elapsed))
+    finally:
+        server.close(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Cost of showing diagnostics with one clangd#RenderDiagnostics() call per
+update against a matchadd() and a :sign command per item. DiagnosticsRenderer
+runs against a vim module that records what it is asked to do, then a
+headless vim replays the records and times them.
+
+    python python/tests/bench_diagnostics.py [diagnostics] [vim]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+# diagnostics are spread over a buffer somewhat longer than their count
+EXTRA_LINES = 1000
+LINE = '    int value = compute(argument, other_argument);'
+UPDATED = 50
+
+
+class Current(object):
+    def __init__(self):
+        self.buffer = []
+
+
+class RecordingVim(object):
+    """Stands in for vim: answers the feature checks and keeps every other
+    call, ('c', command) or ('e', expression)."""
+    def __init__(self):
+        self.current = Current()
+        self.textprop = True
+        self.calls = []
+        # where vim 9 starts, 1 to 3 are kept for :match
+        self._next_match = 1000
+
+    def eval(self, expr):
+        if expr == "has('textprop') && exists('*sign_placelist')":
+            return '1' if self.textprop else '0'
+        if expr == "exists('*sign_place')":
+            return '1'
+        if expr == 'win_getid()':
+            return '1000'
+        if expr.startswith('matchadd('):
+            # vim is told the id, so matchdelete() finds the same match
+            self._next_match += 1
+            self.calls.append(('e', '%s, 10, %d)' % (expr[:-1],
+                                                     self._next_match)))
+            return str(self._next_match)
+        self.calls.append(('e', expr))
+        return '0'
+
+    def command(self, command):
+        self.calls.append(('c', command))
+
+
+vim = RecordingVim()
+sys.modules['vim'] = vim
+
+from clangd.diagnostics_renderer import DiagnosticsRenderer
+
+
+def _Diagnostics(lines, first=1):
+    """One diagnostic per line from first on, errors and warnings taking
+    turns."""
+    return dict((line, [{'severity': 3 if line % 2 else 2, 'col': 5}])
+                for line in range(first, first + lines))
+
+
+def _Updates(count):
+    """(name, lined diagnostics) in the order they are shown."""
+    updated = _Diagnostics(count)
+    for line in range(1, UPDATED + 1):
+        del updated[line]
+    for line in range(count + 1, count + UPDATED + 1):
+        updated[line] = [{'severity': 3, 'col': 3}]
+    # a line inserted at the top moves all of them
+    shifted = dict((line + 1, diagnostics)
+                   for line, diagnostics in updated.items())
+    return [('first', _Diagnostics(count)),
+            ('update', updated),
+            ('shift', shifted)]
+
+
+def _Record(textprop, updates, directory):
+    vim.textprop = textprop
+    renderer = DiagnosticsRenderer()
+    mode = 'batched' if textprop else 'per-item'
+    runs = []
+    for name, diagnostics in updates:
+        del vim.calls[:]
+        start = time.time()
+        renderer.render(1, diagnostics)
+        elapsed = time.time() - start
+        path = os.path.join(directory, '%s-%s.txt' % (mode, name))
+        with open(path, 'w') as f:
+            f.write(''.join('%s %s\n' % call for call in vim.calls))
+        print('%-8s %-6s python %7.1fms, %5d vim calls' %
+              (mode, name, elapsed * 1000, len(vim.calls)))
+        runs.append((mode, name, path))
+    return runs
+
+
+SCRIPT = r"""
+set nomore
+source %(autoload)s
+call setline(1, repeat([%(line)s], %(lines)d))
+highlight link clangdErrorSection SpellBad
+highlight link clangdWarningSection SpellCap
+call prop_type_add('clangdErrorSection', {'highlight': 'clangdErrorSection'})
+call prop_type_add('clangdWarningSection',
+      \ {'highlight': 'clangdWarningSection'})
+sign define clangdError text=>> texthl=Error
+sign define clangdWarning text=>> texthl=Todo
+let s:out = []
+for [s:mode, s:name, s:path] in %(runs)s
+  if s:name == 'first'
+    " start over with the buffer as it was
+    call clearmatches()
+    call sign_unplace('clangd')
+    call prop_remove({'type': 'clangdErrorSection', 'all': 1})
+    call prop_remove({'type': 'clangdWarningSection', 'all': 1})
+    if getline(1) == ''
+      1delete
+    endif
+  elseif s:name == 'shift'
+    call append(0, '')
+  endif
+  let s:calls = readfile(s:path)
+  let s:start = reltime()
+  for s:call in s:calls
+    if s:call[0] == 'c'
+      exe s:call[2:]
+    else
+      call eval(s:call[2:])
+    endif
+  endfor
+  call add(s:out, printf('%%-8s %%-6s vim    %%7.1fms, %%5d highlights, '
+        \ . '%%5d signs', s:mode, s:name, reltimefloat(reltime(s:start)) * 1000,
+        \ len(getmatches()) + len(prop_list(1, {'end_lnum': -1})),
+        \ len(sign_getplaced(1, {'group': 'clangd'})[0].signs)))
+endfor
+call writefile(s:out, %(output)s)
+qa!
+"""
+
+
+def _VimString(text):
+    return "'%s'" % text.replace("'", "''")
+
+
+def _Run(executable, count, updates, directory):
+    runs = (_Record(False, updates, directory) +
+            _Record(True, updates, directory))
+    script = os.path.join(directory, 'bench.vim')
+    output = os.path.join(directory, 'out.txt')
+    with open(script, 'w') as f:
+        f.write(SCRIPT % {
+            'autoload': os.path.join(PLUGIN_DIR, 'autoload', 'clangd.vim'),
+            'line': _VimString(LINE),
+            'lines': count + EXTRA_LINES,
+            'runs': '[%s]' % ', '.join(
+                '[%s]' % ', '.join(_VimString(part) for part in run)
+                for run in runs),
+            'output': _VimString(output)})
+    try:
+        subprocess.call([executable, '-Nu', 'NONE', '-i', 'NONE', '-es',
+                         '-S', script])
+    except OSError:
+        print('%s not found, vim timings skipped' % executable)
+        return
+    if not os.path.exists(output):
+        print('%s failed, it needs +textprop and sign_placelist()' %
+              executable)
+        return
+    with open(output) as f:
+        sys.stdout.write(f.read())
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    executable = sys.argv[2] if len(sys.argv) > 2 else 'vim'
+    vim.current.buffer.extend([LINE] * (count + EXTRA_LINES))
+    updates = _Updates(count)
+    directory = tempfile.mkdtemp()
+    try:
+        _Run(executable, count, updates, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
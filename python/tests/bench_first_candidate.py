@@ -0,0 +1,90 @@
+"""Time to the first completion candidates against payload size. The fake
+server writes each reply in chunks, as a busy pipe delivers it, and the
+first items are published before the rest of the body is read.
+
+    python python/tests/bench_first_candidate.py [items ...]
+"""
+import json
+import logging
+import os
+import sys
+import time
+
+# puts the plugin on sys.path as well
+from test_jsonrpc import FakeServer, Observer, Completion_REQUEST
+
+from clangd.jsonrpc import JsonRPCClient
+
+CHUNK_BYTES = 16 * 1024
+CHUNK_PAUSE_S = 0.001
+
+
+class ChunkedServer(FakeServer):
+    def __init__(self):
+        FakeServer.__init__(self, self._OnMessage)
+        self._result = b''
+
+    def setItems(self, count):
+        """Encodes the reply up front, so only its delivery is timed."""
+        items = [{'label': 'candidate%d' % i, 'kind': 3,
+                  'insertText': 'candidate%d' % i,
+                  'sortText': '%08d' % i,
+                  'detail': 'int candidate%d(int argument)' % i}
+                 for i in range(count)]
+        self._result = json.dumps({'isIncomplete': False,
+                                   'items': items}).encode('utf-8')
+        return len(self._result)
+
+    def _OnMessage(self, server, message):
+        if message.get('method') != Completion_REQUEST:
+            return
+        body = (b'{"jsonrpc": "2.0", "id": ' + str(message['id']).encode(
+            'utf-8') + b', "result": ' + self._result + b'}')
+        data = ('Content-Length: %d\r\n\r\n' % len(body)).encode(
+            'utf-8') + body
+        for offset in range(0, len(data), CHUNK_BYTES):
+            os.write(self._response_write, data[offset:offset + CHUNK_BYTES])
+            time.sleep(CHUNK_PAUSE_S)
+
+
+class FirstCandidates(Observer):
+    def __init__(self):
+        Observer.__init__(self)
+        self.first = None
+
+    def onPartialResponse(self, method, context, response):
+        if self.first is None:
+            self.first = time.time()
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [500, 1000, 2000, 5000,
+                                                  10000]
+    logging.disable(logging.WARNING)
+    server = ChunkedServer()
+    server.start()
+    observer = FirstCandidates()
+    client = JsonRPCClient(observer, server.client_input,
+                           server.client_output)
+    try:
+        for size in sizes:
+            body = server.setItems(size)
+            observer.first = None
+            results = []
+            start = time.time()
+            client.sendRequestAsync(Completion_REQUEST, {}, results.append,
+                                    partial=True)
+            while not results:
+                client.handleRecv()
+                time.sleep(0.0005)
+            done = time.time()
+            first = ('%7.1fms' % ((observer.first - start) * 1000)
+                     if observer.first else '      -  ')
+            print('%6d items, %6.0fKB: first candidates %s, all %7.1fms' %
+                  (size, body / 1024.0, first, (done - start) * 1000))
+    finally:
+        server.close(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Throughput of MessageFramer over a multi-MB stream of mixed ASCII and
+UTF-8 messages, fed in chunks of the sizes the io thread reads.
+
+    python python/tests/bench_framing.py [megabytes]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clangd.jsonrpc import MessageFramer
+
+CHUNK_SIZES = [4096, 65536, 1024 * 1024]
+
+
+def _Frame(message):
+    body = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    return ('Content-Length: %d\r\n\r\n' % len(body)).encode('utf-8') + body
+
+
+def _Messages(megabytes):
+    """Diagnostics, small and large completion replies, with non-ASCII text
+    in every other one."""
+    messages = []
+    size = 0
+    n = 0
+    while size < megabytes * 1024 * 1024:
+        text = u'caf\u00e9 \u540d\u524d' if n % 2 else u'cafe name'
+        if n % 10 == 0:
+            items = 2000
+        elif n % 3 == 0:
+            items = 0
+        else:
+            items = 50
+        if items:
+            message = {'jsonrpc': '2.0', 'id': n, 'result': {
+                'isIncomplete': False,
+                'items': [{'label': u'%s_%d' % (text, i), 'kind': 3,
+                           'insertText': u'item_%d' % i,
+                           'detail': text} for i in range(items)]}}
+        else:
+            message = {'jsonrpc': '2.0',
+                       'method': 'textDocument/publishDiagnostics',
+                       'params': {'uri': 'file:///tmp/a.cc', 'diagnostics': [
+                           {'message': text, 'severity': 1}]}}
+        frame = _Frame(message)
+        messages.append(frame)
+        size += len(frame)
+        n += 1
+    return messages
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    messages = _Messages(megabytes)
+    stream = b''.join(messages)
+    print('%d messages, %.1f MB' % (len(messages), len(stream) / 1e6))
+    for chunk_size in CHUNK_SIZES:
+        framer = MessageFramer()
+        count = 0
+        start = time.time()
+        for offset in range(0, len(stream), chunk_size):
+            framer.feed(stream[offset:offset + chunk_size])
+            body = framer.nextMessage()
+            while body is not None:
+                count += 1
+                body = framer.nextMessage()
+        elapsed = time.time() - start
+        assert count == len(messages)
+        print('chunks of %7d bytes: %6.1f MB/s, %7.0f messages/s' %
+              (chunk_size, len(stream) / elapsed / 1e6, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Memory and latency of PrefixIndex against the Trie it replaced.
+
+    python python/tests/bench_prefix_index.py [completion.json ...]
+
+Each file holds a textDocument/completion reply captured from clangd (the
+whole response, its result, or the items list), for instance copied from
+clangd's --log=verbose output. Without files, the identifiers of the
+system's C and C++ headers stand in for a completion after `std::` or at
+global scope.
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # python2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clangd.prefix_index import PrefixIndex
+
+# the first one found
+HEADER_DIRS = ['/usr/include/c++', '/usr/include']
+MAX_HEADER_WORDS = 5000
+IDENTIFIER = re.compile(r'\b[A-Za-z_][A-Za-z0-9_]{2,}\b')
+TYPED_WORDS = 200
+
+
+# the trie as it was before PrefixIndex, printable ascii only
+TRIE_NODE_SIZE = ord('~') - ord(' ') + 1
+
+
+class TrieNode(object):
+    def __init__(self):
+        self._children = [None] * TRIE_NODE_SIZE
+        self._is_leaf = False
+        self._leaf_data = []
+
+
+class Trie(object):
+    def __init__(self):
+        self.root = TrieNode()
+
+    def insert(self, word, data=None):
+        p_crawl = self.root
+        for c in word:
+            index = ord(c) - ord(' ')
+            if not p_crawl._children[index]:
+                p_crawl._children[index] = TrieNode()
+            p_crawl = p_crawl._children[index]
+        p_crawl._is_leaf = True
+        if data is not None:
+            p_crawl._leaf_data.append(data)
+
+    def _iterNodes(self, p_crawl):
+        results = []
+        if p_crawl._is_leaf:
+            results.extend(p_crawl._leaf_data)
+        for child in p_crawl._children:
+            if child:
+                results.extend(self._iterNodes(child))
+        return results
+
+    def searchPrefix(self, word):
+        p_crawl = self.root
+        for c in word:
+            p_crawl = p_crawl._children[ord(c) - ord(' ')]
+            if not p_crawl:
+                return []
+        return self._iterNodes(p_crawl)
+
+
+def _CompletionWords(path):
+    with open(path) as f:
+        reply = json.load(f)
+    if isinstance(reply, dict) and 'result' in reply:
+        reply = reply['result']
+    if isinstance(reply, dict):
+        reply = reply.get('items', [])
+    # what the manager indexes
+    return [item.get('insertText', item['label']) for item in reply]
+
+
+def _HeaderWords():
+    words = set()
+    for top in HEADER_DIRS:
+        if os.path.isdir(top):
+            break
+    for root, _, files in os.walk(top):
+        for name in files:
+            try:
+                with open(os.path.join(root, name)) as f:
+                    words.update(IDENTIFIER.findall(f.read()))
+            except (IOError, UnicodeDecodeError):
+                continue
+    words = sorted(words)
+    random.Random(0).shuffle(words)
+    return words[:MAX_HEADER_WORDS]
+
+
+def _Build(cls, words):
+    start = time.time()
+    index = cls()
+    for n, word in enumerate(words):
+        index.insert(word, ('%08d' % n, n))
+    # PrefixIndex sorts on the first lookup
+    index.searchPrefix(u'~')
+    return index, time.time() - start
+
+
+def _Measure(cls, words, typed):
+    if tracemalloc:
+        tracemalloc.start()
+    index, build = _Build(cls, words)
+    memory = tracemalloc.get_traced_memory()[0] if tracemalloc else 0
+    if tracemalloc:
+        tracemalloc.stop()
+    # the lookups made while typing the first three letters of a word
+    start = time.time()
+    for word in typed:
+        for length in (1, 2, 3):
+            index.searchPrefix(word[:length])
+    lookup = (time.time() - start) / (len(typed) * 3)
+    memory = '%6.2fMB' % (memory / 1e6) if tracemalloc else '   n/a  '
+    print('%-11s build %7.1fms, memory %s, lookup %7.3fms' %
+          (cls.__name__, build * 1000, memory, lookup * 1000))
+    return index
+
+
+def main():
+    if len(sys.argv) > 1:
+        corpora = [(path, _CompletionWords(path)) for path in sys.argv[1:]]
+    else:
+        corpora = [('system headers', _HeaderWords())]
+    for name, words in corpora:
+        # the trie can't hold anything else
+        ascii_words = [word for word in words
+                       if all(' ' <= c <= '~' for c in word)]
+        typed = random.Random(0).sample(ascii_words,
+                                        min(TYPED_WORDS, len(ascii_words)))
+        print('%s: %d words, %d ascii' % (name, len(words),
+                                          len(ascii_words)))
+        _Measure(Trie, ascii_words, typed)
+        index = _Measure(PrefixIndex, words, typed)
+        start = time.time()
+        for word in typed:
+            for length in (1, 2, 3):
+                index.topPrefix(word[:length], 50)
+        print('%-11s top 50 %.3fms' % ('', (time.time() - start) * 1000 /
+                                       (len(typed) * 3)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sys
+import unittest
+from threading import Thread
+from time import sleep
+
+try:
+    import tracemalloc
+except ImportError:
+    # python2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clangd.jsonrpc import JsonRPCClient, EXPIRE_INTERVAL_MS, MAX_PENDING_REQUESTS
+
+Completion_REQUEST = 'textDocument/completion'
+Formatting_REQUEST = 'textDocument/formatting'
+WorkDoneProgressCreate_REQUEST = 'window/workDoneProgress/create'
+
+
+class FakeServer(Thread):
+    """Plays clangd over a pair of pipes, every message from the client is
+    passed to on_message(server, message) on the server thread."""
+    def __init__(self, on_message):
+        Thread.__init__(self)
+        self.daemon = True
+        self._on_message = on_message
+        self._request_read, self.client_input = os.pipe()
+        self.client_output, self._response_write = os.pipe()
+
+    def send(self, message):
+        body = json.dumps(message).encode('utf-8')
+        header = ('Content-Length: %d\r\n\r\n' % len(body)).encode('utf-8')
+        os.write(self._response_write, header + body)
+
+    def run(self):
+        data = b''
+        while True:
+            chunk = os.read(self._request_read, 65536)
+            if not chunk:
+                return
+            data += chunk
+            while b'\r\n\r\n' in data:
+                header, body = data.split(b'\r\n\r\n', 1)
+                length = int(header.split(b':')[1])
+                if len(body) < length:
+                    break
+                data = body[length:]
+                self._on_message(self, json.loads(body[:length].decode('utf-8')))
+
+    def close(self, client):
+        client.stop()
+        os.close(self.client_input)
+        self.join(1)
+        for fd in (self._request_read, self.client_output,
+                   self._response_write):
+            os.close(fd)
+
+
+class Observer(object):
+    def __init__(self):
+        self.responses = []
+        self.is_down = False
+
+    def onNotification(self, method, params):
+        pass
+
+    def onResponse(self, method, context, response):
+        self.responses.append((method, response))
+
+    def onPartialResponse(self, method, context, response):
+        pass
+
+    def onServerDown(self):
+        self.is_down = True
+
+
+class ServerRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.progress_replies = []
+        self.server = FakeServer(self._OnMessage)
+        self.server.start()
+        self.observer = Observer()
+        self.client = JsonRPCClient(self.observer, self.server.client_input,
+                                    self.server.client_output)
+        self.client.registerRequestHandler(WorkDoneProgressCreate_REQUEST,
+                                           lambda params: None)
+
+    def tearDown(self):
+        self.server.close(self.client)
+
+    def _OnMessage(self, server, message):
+        # like clangd, ask for a progress token before answering, and only
+        # answer once the client replied
+        if message.get('method') == Completion_REQUEST:
+            self.completion_id = message['id']
+            server.send({'jsonrpc': '2.0', 'id': 'progress',
+                         'method': WorkDoneProgressCreate_REQUEST,
+                         'params': {'token': 'backgroundIndexProgress'}})
+        elif message.get('id') == 'progress':
+            self.progress_replies.append(message)
+            server.send({'jsonrpc': '2.0', 'id': self.completion_id,
+                         'result': {'isIncomplete': False, 'items': []}})
+
+    def testCompletionAfterProgressCreate(self):
+        result = self.client.sendRequest(Completion_REQUEST, {}, False, 2000)
+        self.assertEqual(result, {'isIncomplete': False, 'items': []})
+        self.assertEqual(len(self.progress_replies), 1)
+        self.assertEqual(self.progress_replies[0].get('result', 0), None)
+        self.assertFalse(self.observer.is_down)
+
+
+class StaleResponseTest(unittest.TestCase):
+    URI = 'file:///tmp/a.cc'
+
+    def setUp(self):
+        self.requests = []
+        self.server = FakeServer(self._OnMessage)
+        self.server.start()
+        self.client = JsonRPCClient(Observer(), self.server.client_input,
+                                    self.server.client_output)
+        self.client.sendNotification('textDocument/didOpen', {
+            'textDocument': {'uri': self.URI, 'version': 1, 'text': ''}})
+
+    def tearDown(self):
+        self.server.close(self.client)
+
+    def _OnMessage(self, server, message):
+        # answers once the document changed under the requests
+        if message.get('method') == 'textDocument/didChange':
+            for request in self.requests:
+                server.send({'jsonrpc': '2.0', 'id': request['id'],
+                             'result': [request['method']]})
+        elif 'id' in message:
+            self.requests.append(message)
+
+    def _Send(self, method, versioned):
+        results = []
+        params = {'textDocument': {'uri': self.URI}}
+        self.client.sendRequestAsync(method, params, results.append,
+                                     versioned=versioned)
+        return results
+
+    def testOnlyVersionedResponsesAreDropped(self):
+        completions = self._Send(Completion_REQUEST, False)
+        edits = self._Send(Formatting_REQUEST, True)
+        self.client.sendNotification('textDocument/didChange', {
+            'textDocument': {'uri': self.URI, 'version': 2},
+            'contentChanges': []})
+        for _ in range(100):
+            self.client.handleRecv()
+            if completions and edits:
+                break
+            sleep(0.01)
+        self.assertEqual(completions, [[Completion_REQUEST]])
+        self.assertEqual(edits, [None])
+        self.assertEqual(self.client.staleCounts(), {Formatting_REQUEST: 1})
+
+
+class UnansweredRequestsTest(unittest.TestCase):
+    TTL_MS = 50
+
+    def setUp(self):
+        # each expired request is logged
+        logging.disable(logging.WARNING)
+        self.server = FakeServer(lambda server, message: None)
+        self.server.start()
+        self.client = JsonRPCClient(Observer(), self.server.client_input,
+                                    self.server.client_output, self.TTL_MS)
+
+    def tearDown(self):
+        self.server.close(self.client)
+        logging.disable(logging.NOTSET)
+
+    def _Flood(self, count):
+        results = []
+        for i in range(count):
+            if i % 2:
+                self.client.sendRequestAsync(Completion_REQUEST, {},
+                                             results.append)
+            else:
+                self.client.sendRequest(Completion_REQUEST, {}, True, None)
+            self.assertLessEqual(self.client.pendingCounts()['pending'],
+                                 MAX_PENDING_REQUESTS)
+        return results
+
+    def _Expire(self):
+        sleep((self.TTL_MS + EXPIRE_INTERVAL_MS) * 0.001 + 0.1)
+        self.client.handleRecv()
+
+    def testPendingRequestsAreBounded(self):
+        count = 3 * MAX_PENDING_REQUESTS
+        results = self._Flood(count)
+        self._Expire()
+        counts = self.client.pendingCounts()
+        self.assertEqual(counts['pending'], 0)
+        self.assertEqual(counts['expired'] + counts['evicted'], count)
+        # every callback is called once, as failed
+        self.assertEqual(results, [None] * (count // 2))
+
+    @unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+    def testExpiredRequestsAreReleased(self):
+        tracemalloc.start()
+        try:
+            # the first round sizes the queues and tables
+            self._Flood(2 * MAX_PENDING_REQUESTS)
+            self._Expire()
+            before = tracemalloc.get_traced_memory()[0]
+            self._Flood(2 * MAX_PENDING_REQUESTS)
+            self._Expire()
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        # buffers still held by the io thread vary by tens of KB, a leaked
+        # future per request would be over a MB
+        self.assertLess(after - before, 256 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()